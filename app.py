@@ -1,16 +1,23 @@
-from flask import Flask, jsonify, request
+from flask import Blueprint, Flask, Response, jsonify, request
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
 from src.wallet import Wallet
 from src.block import Block
 from src.transaction import Transaction, deserialize_trans
-
+from src.verifier import SignatureVerifier
+from src.codec import BINARY_CONTENT_TYPE, DECODE_ERRORS, decode_transactions, decode_block, encode_block, encode_blocks
+from src.sync import SYNC_CHUNK_SIZE
+from src.bounded import DEBUG_PAGE_SIZE
+from src import metrics
+from src.metrics import RECEIVE_TRANSACTION_SECONDS, RECEIVE_BLOCK_SECONDS, BLOCK_APPLY_SECONDS, timed
+
+import atexit
 import os
 import sys
 import json
-import requests
 import threading
 import time
 import subprocess
-from copy import deepcopy
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -18,62 +25,64 @@ load_dotenv()
 BOOTSTRAP_IP = os.getenv("BOOTSTRAP_IP")  # 127.0.0.1
 BOOTSTRAP_PORT = int(os.getenv("BOOTSTRAP_PORT"))  # 5000
 TOTAL_NODES = int(os.getenv("TOTAL_NODES"))
-CAPACITY = int(os.getenv("CAPACITY"))
 INITIAL_COINS = int(os.getenv("INITIAL_COINS"))  # 1000
 PRINT_TRANS = int(os.getenv("PRINT_TRANS"))  # for printing
 RUN_DRIVER = int(os.getenv("RUN_DRIVER"))  # for executing driver
-
-app = Flask('BlockChat')
-
-ip_address = sys.argv[1]
-port = int(sys.argv[2])
-
-bootstrap = ip_address == BOOTSTRAP_IP and port == BOOTSTRAP_PORT
-
-wallet = Wallet(ip_address, port, bootstrap)
-
+STATE_BROADCAST_TIMEOUT = float(os.getenv("STATE_BROADCAST_TIMEOUT", "30"))  # seconds to wait for the nodes to start
+SERVER = os.getenv("SERVER", "waitress")  # waitress (production server) or dev (the Flask development server)
+SERVER_THREADS = int(os.getenv("SERVER_THREADS", "16"))  # threads that handle the requests
+SERVER_CONNECTION_LIMIT = int(os.getenv("SERVER_CONNECTION_LIMIT", "1000"))  # open connections (keep-alive included)
+SERVER_BACKLOG = int(os.getenv("SERVER_BACKLOG", "1024"))  # connections waiting to be accepted
+SERVER_CHANNEL_TIMEOUT = int(os.getenv("SERVER_CHANNEL_TIMEOUT", "120"))  # seconds an idle keep-alive connection is kept
+# blocks received this far ahead of the chain at most are buffered, the node syncs with its peers for the later ones
+PENDING_BLOCKS_WINDOW = int(os.getenv("PENDING_BLOCKS_WINDOW", "16"))
+
+# The routes of every node, of the bootstrap only and of the other nodes only (see create_app)
+api = Blueprint('api', __name__)
+bootstrap_api = Blueprint('bootstrap_api', __name__)
+node_api = Blueprint('node_api', __name__)
+
+# The state of the node in this process, set by init_node
+ip_address = None
+port = None
+bootstrap = False
+signature_verifier = None
+wallet = None
 network_full = threading.Event()
-
-flag = True
+sync_lock = threading.Lock()  # held while the node pulls blocks from its peers, so one sync runs at a time
+# for starting the driver once (not again after a restart)
+flag = False
 
 
 def broadcast_network_blockchain():
+    """
+    Send the state of the network to every node, once all of them have registered. The nodes then pull
+    the blocks from their peers (see sync_chain), so the bootstrap does not push the chain to each of them.
+    """
     network_full.wait()
 
-    time.sleep(2)
-
     wallet.total_lock.acquire()
+    wallet.nonces.reset(wallet.blockchain_state.keys())
+    wallet.committed_nonces.reset(wallet.blockchain_state.keys())
+    payload = json.dumps(wallet.blockchain_state)
+    wallet.save_node_info()
+    wallet.total_lock.release()
 
-    for node in wallet.blockchain_state.keys():
-        wallet.nonce_sets[node] = set()
-
-        if node == wallet.address:
-            continue  # We don't want to send the blockchain to the bootstrap (ourselves)
-
-        node_ip = node.split(":")[0]
-        node_port = node.split(":")[1]
-        payload = json.dumps(wallet.blockchain_state)
-        response = requests.post(f"http://{node_ip}:{node_port}/api/regular/receive_state",
-                                 data=payload,
-                                 headers={'Content-Type': 'application/json'})
-        if response.status_code != 200:
-            print("Error:", response.json())
-            wallet.total_lock.release()
-            sys.exit(1)
-
-        for block in wallet.blockchain.chain:
-            payload = block.serialize()
-            response = requests.post(f"http://{node_ip}:{node_port}/api/receive_block",
-                                     data=payload,
-                                     headers={'Content-Type': 'application/json'})
-            if response.status_code != 200:
+    # The last node registers before its server is up, so the nodes that cannot be reached yet are retried
+    nodes = wallet.peer_addresses()
+    deadline = time.time() + STATE_BROADCAST_TIMEOUT
+    while nodes:
+        results = wallet.peers.broadcast(nodes, "/api/regular/receive_state", payload)
+        for node, response in results.items():
+            if response is not None and response.status_code != 200:
                 print("Error:", response.json())
-                wallet.total_lock.release()
                 sys.exit(1)
-
-    wallet.blockchain_state_hard = deepcopy(wallet.blockchain_state)
-
-    wallet.total_lock.release()
+        nodes = [node for node in nodes if results.get(node) is None]
+        if nodes and time.time() > deadline:
+            print("Error: could not send the network state to", nodes)
+            sys.exit(1)
+        if nodes:
+            time.sleep(0.1)
 
     print("All nodes have been registered and informed of the network state and blockchain.")
     print("Will now give 1000 coins to everyone.")
@@ -102,47 +111,78 @@ def give_coins_to_everyone():
 
 def process_incoming_transaction(transaction: Transaction):
     if transaction.sender_address != '0':
-        wallet.transactions_pending[transaction.transaction_id] = transaction
+        wallet.mempool.add(transaction)
     wallet.process_transaction(transaction)
-    if len(wallet.transactions_pending) >= CAPACITY:
-        wallet.capacity_full.set()
+    wallet.notify_producer()
 
     return
 
 
 def miner_thread_func():
     """
-    We use a separate thread for mining that wakes up when an event is set (with timeout for solving lost-wakeup problem).
+    The block producer. It sleeps until it is woken up by the mempool or by a new block (the capacity_full event),
+    or until the oldest pending transaction has waited BLOCK_MAX_WAIT, and seals a block when this node is
+    the validator and the block is full or has waited long enough.
+    The event is cleared before checking, so a wake-up during the check is not lost.
     """
     while True:
-        wallet.capacity_full.wait(timeout=0.05)
-        if len(wallet.transactions_pending) >= CAPACITY:
+        wallet.capacity_full.clear()
+        wait = wallet.next_block_wait()
+        if wait == 0:
+            height = len(wallet.blockchain.chain)
             if not wallet.mine_block():
                 print("Mining failed, exiting...")
                 sys.exit(1)
-        wallet.capacity_full.clear()
+            if len(wallet.blockchain.chain) > height:
+                continue
+            # nothing could be sealed (e.g. no pending transaction fits in a fee-priority block), wait for a change
+            wait = None
+        wallet.capacity_full.wait(timeout=wait)
 
 
-def verify_trans(transaction: Transaction):
-    # Verify the signature of the transaction
-    if not transaction.verify_signature(wallet.blockchain_state[transaction.sender_address]["public_key"]):
-        return False
+def verify_trans(transaction: Transaction, check_signature=True, state=None):
+    # The balance is checked against the soft state, unless another state (or state overlay) is given
+    if state is None:
+        state = wallet.blockchain_state
+
+    # Verify the signature of the transaction, with the cached public key of the sender
+    if check_signature:
+        if not transaction.verify_signature_with(wallet.get_verifier(transaction.sender_address)):
+            return False
+        wallet.verified_cache.add(transaction)
 
     # Verify transaction balance
-    if not transaction.verify_balance(wallet.blockchain_state[transaction.sender_address]["balance"],
-                                      wallet.blockchain_state[transaction.sender_address]["stake"]):
+    if not transaction.verify_balance(state[transaction.sender_address]["balance"],
+                                      state[transaction.sender_address]["stake"]):
         return False
 
     return True
 
 
-@app.route('/api/get_balance')
+@api.route('/api/get_balance')
 def get_balance():
     return jsonify({"balance": wallet.balance}), 200
 
 
-@app.route('/api/view_block', methods=['GET'])
+def binary_request() -> bool:
+    """Content negotiation: transactions and blocks can be sent in the compact binary format (see src/codec.py)."""
+    return request.mimetype == BINARY_CONTENT_TYPE
+
+
+def binary_accepted(accept) -> bool:
+    """
+    Content negotiation of the responses: the binary format if the Accept header prefers it to JSON. Shared with
+    async_app.py, so both runtimes answer the same header the same way.
+    """
+    mimetypes = parse_accept_header(accept, MIMEAccept)
+    return mimetypes.best_match(['application/json', BINARY_CONTENT_TYPE]) == BINARY_CONTENT_TYPE
+
+
+@api.route('/api/view_block', methods=['GET'])
 def view_block():
+    if binary_accepted(request.headers.get('Accept')):
+        return Response(encode_block(wallet.blockchain.chain[-1]), mimetype=BINARY_CONTENT_TYPE)
+
     # Needed to convert the block to JSONifiable dictionary
     block = json.loads(wallet.blockchain.chain[-1].serialize())
     block["transactions"] = list(map(lambda transaction: json.loads(transaction), block["transactions"]))
@@ -150,65 +190,154 @@ def view_block():
     return jsonify(block), 200
 
 
-@app.route('/api/get_network_state')
+@api.route('/api/blocks', methods=['GET'])
+def blocks():
+    """
+    The blocks [from, from + limit) of the chain (at most SYNC_CHUNK_SIZE of them) and the height of the chain,
+    for the nodes that pull the chain. The transactions of the blocks are JSON strings, like in /api/receive_block.
+    """
+    try:
+        start = int(request.args.get('from', 0))
+        limit = min(int(request.args.get('limit', SYNC_CHUNK_SIZE)), SYNC_CHUNK_SIZE)
+    except ValueError:
+        return jsonify({"error": "Invalid parameter(s)"}), 400
+    if start < 0 or limit < 0:
+        return jsonify({"error": "Invalid parameter(s)"}), 400
+
+    height, selected = select_blocks(start, limit)
+
+    if binary_accepted(request.headers.get('Accept')):
+        return Response(encode_blocks(height, selected), mimetype=BINARY_CONTENT_TYPE)
+
+    # The serialized blocks are cached, so they are joined instead of being parsed and encoded again
+    body = f'{{"height": {height}, "blocks": [' + ", ".join(block.serialize() for block in selected) + "]}"
+    return Response(body, mimetype='application/json')
+
+
+def select_blocks(start: int, limit: int) -> tuple:
+    """The height of the chain and its blocks [start, start + limit)."""
+    chain = wallet.blockchain.chain
+    height = len(chain)
+    return height, chain[start:min(start + limit, height)]
+
+
+@api.route('/api/transaction_proof/<transaction_id>', methods=['GET'])
+def transaction_proof(transaction_id):
+    proof = wallet.blockchain.transaction_proof(transaction_id)
+    if proof is None:
+        return jsonify({"error": "Transaction not found in any block"}), 404
+    return jsonify(proof), 200
+
+
+@api.route('/api/get_network_state')
 def get_network_state():
-    return jsonify(wallet.blockchain_state), 200
+    return jsonify(wallet.state.snapshot()), 200
 
 
-@app.route('/api/get_network_state_hard')
+@api.route('/api/get_network_state_hard')
 def get_network_state_hard():
-    return jsonify(wallet.blockchain_state_hard), 200
+    return jsonify(wallet.state.snapshot(hard=True)), 200
+
+
+def page_args() -> tuple:
+    """The offset and limit query parameters of the paginated debug endpoints (limit at most DEBUG_PAGE_SIZE)."""
+    offset = max(int(request.args.get('offset', 0)), 0)
+    limit = min(max(int(request.args.get('limit', DEBUG_PAGE_SIZE)), 0), DEBUG_PAGE_SIZE)
+    return offset, limit
 
 
 # For debugging purposes
-@app.route('/api/transactions_history')
+@api.route('/api/transactions_history')
 def transactions_history():
+    try:
+        offset, limit = page_args()
+    except ValueError:
+        return jsonify({"error": "Invalid parameter(s)"}), 400
     transactions_list = []
-    for transaction in wallet.transaction_history:
+    for transaction in wallet.transaction_history.page(offset, limit):
         transactions_list.append(transaction.serialize())
     return jsonify(transactions_list), 200
 
 
 # For debugging purposes
-@app.route('/api/transaction_counts')
+@api.route('/api/debug_collections')
+def debug_collections():
+    """Size and evictions of the bounded debug collections."""
+    return jsonify({"transaction_history": wallet.transaction_history.stats(),
+                    "transactions_rejected": wallet.transactions_rejected.stats(),
+                    "transactions_missing": wallet.transactions_missing.stats()}), 200
+
+
+# For debugging purposes
+@api.route('/api/transaction_counts')
 def transaction_counts():
     return jsonify({"sent": wallet.nonce, "received": wallet.received_transactions_count,
                     "accepted": wallet.accepted_transactions_count}), 200
 
 
-@app.route('/api/receive_transaction', methods=['POST'])
-def receive_transaction():
-    data = request.json
-    if data is None:
-        return jsonify({"error": "No JSON data provided"}), 400
+# For debugging purposes
+@api.route('/api/block_delivery_status')
+def block_delivery_status():
+    return jsonify(wallet.block_delivery.get_status()), 200
 
-    transaction = deserialize_trans(data['transaction'])
 
-    wallet.total_lock.acquire()
+# For debugging purposes
+@api.route('/api/block_capacity')
+def block_capacity():
+    return jsonify(wallet.block_capacity.stats()), 200
+
+
+@api.route('/metrics')
+def metrics_endpoint():
+    """The metrics of the node in the Prometheus text format (see src/metrics.py)."""
+    if not metrics.METRICS:
+        return jsonify({"error": "Metrics are disabled"}), 404
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
+# For debugging purposes
+@api.route('/api/verified_cache')
+def verified_cache():
+    return jsonify(wallet.verified_cache.stats()), 200
 
+
+@timed(RECEIVE_TRANSACTION_SECONDS)
+def handle_transaction(transaction: Transaction) -> tuple:
+    """
+    Validate and process a received transaction. The caller must hold the total_lock.
+    Returns the response message and the status code.
+    """
     wallet.received_transactions_count += 1
 
-    if transaction.transaction_id in wallet.transactions_missing:
-        del wallet.transactions_missing[transaction.transaction_id]
-        wallet.total_lock.release()
-        return jsonify({"message": "Transaction already processed from previous block"}), 200
+    # The nonce is committed when a block already contained the transaction. This is checked with the nonces
+    # rather than transactions_missing, whose entries may have been evicted by the time the transaction arrives.
+    if wallet.committed_nonces.used(transaction.sender_address, transaction.nonce):
+        wallet.transactions_missing.pop(transaction.transaction_id)
+        return {"message": "Transaction already processed from previous block"}, 200
 
-    if transaction.nonce in wallet.nonce_sets[transaction.sender_address]:
-        wallet.total_lock.release()
-        return jsonify({"message": "Transaction nonce encountered before"}), 400
-    else:
-        wallet.nonce_sets[transaction.sender_address].add(transaction.nonce)
+    if transaction.sender_address not in wallet.blockchain_state:
+        return {"error": "Unknown sender"}, 400
+
+    if wallet.nonces.used(transaction.sender_address, transaction.nonce):
+        return {"message": "Transaction nonce encountered before"}, 400
+    elif wallet.nonces.ahead(transaction.sender_address, transaction.nonce):
+        return {"error": "Transaction nonce too far ahead"}, 400
+    elif wallet.mempool.full():
+        return {"error": "Mempool is full"}, 503
 
     if not verify_trans(transaction):
         wallet.transactions_rejected[transaction.transaction_id] = transaction
-        wallet.total_lock.release()
-        return jsonify({"error": "Invalid signature or balance"}), 400
+        return {"error": "Invalid signature or balance"}, 400
 
+    # the nonce is only recorded once the signature is verified, so a forged transaction cannot use it up
+    wallet.nonces.add(transaction.sender_address, transaction.nonce)
     process_incoming_transaction(transaction)
 
-    wallet.total_lock.release()
+    return {"message": "Transaction processed successfully"}, 200
 
-    # run script
+
+def start_driver():
+    # run script, once the first transaction has been received
     global flag
     if (RUN_DRIVER == 1) and flag and not bootstrap:
         flag = False
@@ -217,69 +346,80 @@ def receive_transaction():
         wallet_id = str(wallet.id)
         process = subprocess.Popen(['python3', script_path, wallet_id, address])
 
-    return jsonify({"message": "Transaction processed successfully"}), 200
 
+@api.route('/api/receive_transaction', methods=['POST'])
+def receive_transaction():
+    if binary_request():
+        try:
+            transaction = decode_transactions(request.get_data())[0]
+        except DECODE_ERRORS:
+            return jsonify({"error": "Invalid binary payload"}), 400
+    else:
+        data = request.json
+        if data is None:
+            return jsonify({"error": "No JSON data provided"}), 400
+
+        transaction = deserialize_trans(data['transaction'])
 
-@app.route('/api/receive_block', methods=['POST'])
-def receive_block():
+    # released on any error too, so a bad transaction can not leave the node locked
+    with wallet.total_lock:
+        message, status = handle_transaction(transaction)
+
+    if status == 200:
+        start_driver()
+
+    return jsonify(message), status
+
+
+@api.route('/api/receive_transactions', methods=['POST'])
+def receive_transactions():
     """
-    Receive a block and update hard_state with the transactions contained inside it.
+    Receive a batch of transactions. The lock is taken once for the whole batch,
+    and the result of every transaction is returned in the same order.
     """
-    data = request.json
-    if data is None:
-        return jsonify({"error": "No JSON data provided"}), 400
+    if binary_request():
+        try:
+            transactions = decode_transactions(request.get_data())
+        except DECODE_ERRORS:
+            return jsonify({"error": "Invalid binary payload"}), 400
+    else:
+        data = request.json
+        if data is None:
+            return jsonify({"error": "No JSON data provided"}), 400
 
-    transactions = []
+        transactions = [deserialize_trans(transaction) for transaction in data['transactions']]
 
-    wallet.total_lock.acquire()
+    results = []
+    with wallet.total_lock:
+        for transaction in transactions:
+            message, status = handle_transaction(transaction)
+            results.append({"transaction_id": transaction.transaction_id, "status": status, **message})
 
-    wallet.blockchain_state = deepcopy(wallet.blockchain_state_hard)
-    for transaction in data['transactions']:
-        # If a transaction has been already received, remove it from transactions_pending.
-        # Else, check if it has been rejected. If yes, remove it from the rejected list (validator forces acceptance).
-        # If not, add it to missing transactions (have not received it yet)
-        trans_object = deserialize_trans(transaction)
-        if trans_object.sender_address != '0' and not verify_trans(trans_object):
-            wallet.total_lock.release()
-            return jsonify({"message": "Block contained invalid transactions"}), 400
-        transactions.append(trans_object)
-        if trans_object.sender_address != '0':
-            wallet.process_transaction(trans_object)
-            if PRINT_TRANS == 1:
-                file_path = f"{wallet.id}-trans.txt"
-                with open(file_path, 'a') as file:
-                    file.write(f"{trans_object.sender_address} - {trans_object.nonce}\n")
-                file_path = f"{wallet.id}-trans-place.txt"
-                with open(file_path, 'a') as file:
-                    file.write(f"{trans_object.sender_address} - {trans_object.nonce} FROM RECEIVE_BLOCK\n")
-        try:
-            del wallet.transactions_pending[trans_object.transaction_id]
-        except KeyError:
-            if trans_object.sender_address == "0":
-                continue
-            else:
-                if trans_object.transaction_id in wallet.transactions_rejected:
-                    del wallet.transactions_rejected[trans_object.transaction_id]
-                    continue
-                else:
-                    wallet.nonce_sets[trans_object.sender_address].add(trans_object.nonce)
-                    wallet.transactions_missing[trans_object.transaction_id] = trans_object
-                    continue
-        except Exception:
-            wallet.total_lock.release()
-            return jsonify({"message": "Some error occurred"}), 400
-
-    block = Block(data['index'], data['timestamp'], transactions, data['validator'], data['previous_hash'])
-
-    # If a block has been received out of order, wait until the previous block has been added.
-    # First, save the current pending list & the current soft-state, before releasing the lock
-    current_pending = deepcopy(wallet.transactions_pending)
-    current_soft_state = deepcopy(wallet.blockchain_state)
-    while data['index'] != len(wallet.blockchain.chain):
-        wallet.total_lock.release()
-        wallet.received_block.wait(timeout=0.05)
-        wallet.received_block.clear()
-        wallet.total_lock.acquire()
+    if any(result["status"] == 200 for result in results):
+        start_driver()
+
+    return jsonify({"results": results}), 200
+
+
+def apply_block(data: dict, transactions: list) -> tuple:
+    """
+    Validate the next block of the chain (whose signatures are already verified) and commit it.
+    The caller must hold the total_lock. Returns the response message and the status code.
+    """
+    start = time.time()
+
+    # Check the balances of the transactions one after the other on a copy-on-write view of the hard state,
+    # so nothing has to be undone if the block turns out to be invalid.
+    overlay = wallet.state.overlay()
+    for trans_object in transactions:
+        if trans_object.sender_address == '0':
+            continue
+        if not verify_trans(trans_object, check_signature=False, state=overlay):
+            return {"message": "Block contained invalid transactions"}, 400
+        overlay.apply(trans_object)
+
+    block = Block(data['index'], data['timestamp'], transactions, data['validator'], data['previous_hash'],
+                  data['capacity'])
 
     if data['previous_hash'] == '1':
         validator = 0
@@ -287,14 +427,38 @@ def receive_block():
         validator = wallet.lottery(data['index'])
 
     if not block.validate_block(wallet.blockchain, validator):
-        wallet.total_lock.release()
-        return jsonify({"error": "Invalid block"}), 400
+        return {"error": "Invalid block"}, 400
 
     wallet.blockchain.add_block(block)
-    wallet.received_block.set()
+
+    for trans_object in transactions:
+        # The genesis transaction is already contained in the state received from the bootstrap
+        if trans_object.sender_address == '0':
+            continue
+
+        # Commit the transaction to the hard state (the soft state already has it, if it was pending)
+        wallet.state.commit(trans_object)
+        wallet.committed_nonces.add(trans_object.sender_address, trans_object.nonce)
+        if PRINT_TRANS == 1:
+            file_path = f"{wallet.id}-trans.txt"
+            with open(file_path, 'a') as file:
+                file.write(f"{trans_object.sender_address} - {trans_object.nonce}\n")
+            file_path = f"{wallet.id}-trans-place.txt"
+            with open(file_path, 'a') as file:
+                file.write(f"{trans_object.sender_address} - {trans_object.nonce} FROM RECEIVE_BLOCK\n")
+
+        # If a transaction has been already received, remove it from the mempool.
+        # Else, check if it has been rejected. If yes, remove it from the rejected list (validator forces acceptance).
+        # If not, add it to missing transactions (have not received it yet)
+        if trans_object.transaction_id in wallet.mempool:
+            wallet.mempool.remove(trans_object.transaction_id)
+        elif trans_object.transaction_id in wallet.transactions_rejected:
+            del wallet.transactions_rejected[trans_object.transaction_id]
+        else:
+            wallet.nonces.add(trans_object.sender_address, trans_object.nonce)
+            wallet.transactions_missing[trans_object.transaction_id] = trans_object
 
     # update the validator balance
-    key_validator = None
     for key, value in wallet.blockchain_state.items():
         if value['id'] == validator:
             if PRINT_TRANS == 1:
@@ -304,24 +468,117 @@ def receive_block():
                 file_path = f"{wallet.id}-trans-place.txt"
                 with open(file_path, 'a') as file:
                     file.write(f"{key} is given {block.calculate_reward()} FROM RECEIVE_BLOCK\n")
-            wallet.blockchain_state[key]['balance'] += block.calculate_reward()
-            key_validator = key
+            wallet.state.credit(key, block.calculate_reward())
             break
 
-    wallet.blockchain_state_hard = deepcopy(current_soft_state)
-    wallet.blockchain_state_hard[key_validator]['balance'] += block.calculate_reward()
+    wallet.snapshot_if_due()
+    wallet.block_capacity.record_apply(time.time() - start)
+    BLOCK_APPLY_SECONDS.observe(time.time() - start)
+
+    # the validator of the next block may be this node
+    wallet.capacity_full.set()
+
+    return {"message": "Block received successfully"}, 200
 
-    # Process again the remaining pending transactions because their effect has been canceled,
-    # when soft_state became hard_state.
-    for transaction in current_pending.values():
-        wallet.process_transaction(transaction)
+
+@timed(RECEIVE_BLOCK_SECONDS)
+def accept_block(data: dict, transactions: list) -> tuple:
+    """
+    Add a block received from a peer (pushed to /api/receive_block or pulled with /api/blocks).
+    Returns the response message and the status code.
+    """
+    # Verify the signatures before taking the lock (in parallel, if a process pool is configured),
+    # only the balances have to be checked against the state while holding the lock.
+    signed = [transaction for transaction in transactions if transaction.sender_address != '0']
+    try:
+        public_keys = {transaction.sender_address: wallet.blockchain_state[transaction.sender_address]["public_key"]
+                       for transaction in signed}
+    except KeyError:
+        return {"message": "Block contained transactions from unknown nodes"}, 400
+    if not signature_verifier.verify_all(signed, public_keys, wallet.get_verifier, wallet.verified_cache):
+        return {"message": "Block contained invalid transactions"}, 400
+
+    wallet.total_lock.acquire()
+
+    chain_length = len(wallet.blockchain.chain)
+    if data['index'] < chain_length:
+        # Already in the chain (e.g. a retried delivery)
+        same = wallet.blockchain.chain[data['index']].current_hash == data.get('current_hash')
+        wallet.total_lock.release()
+        if same:
+            return {"message": "Block already received"}, 200
+        return {"error": "A different block with this index is already in the chain"}, 400
+
+    if data['index'] > chain_length + PENDING_BLOCKS_WINDOW:
+        # Too far ahead to buffer: pull the missing blocks, the sender retries this one later
+        wallet.total_lock.release()
+        start_sync()
+        return {"error": "Block too far ahead of the chain, syncing with the peers"}, 503
+
+    if data['index'] > chain_length:
+        # Received out of order: keep it until the blocks before it have been added, and acknowledge it right away
+        wallet.pending_blocks[data['index']] = (data, transactions)
+        wallet.total_lock.release()
+        return {"message": "Block buffered until the previous blocks are received"}, 200
+
+    message, status = apply_block(data, transactions)
+
+    # Add the buffered blocks that can now follow
+    while status == 200 and len(wallet.blockchain.chain) in wallet.pending_blocks:
+        buffered_data, buffered_transactions = wallet.pending_blocks.pop(len(wallet.blockchain.chain))
+        buffered_message, buffered_status = apply_block(buffered_data, buffered_transactions)
+        if buffered_status != 200:
+            print(f"Buffered block {buffered_data['index']} was rejected:", buffered_message)
+            break
+
+    # Drop the buffered blocks whose index has been filled by another block
+    for index in [index for index in wallet.pending_blocks if index < len(wallet.blockchain.chain)]:
+        del wallet.pending_blocks[index]
 
     wallet.total_lock.release()
 
-    return jsonify({"message": "Block received successfully"}), 200
+    return message, status
+
+
+def sync_chain() -> None:
+    """Pull the blocks this node is missing from its peers. The caller must hold the sync_lock (see start_sync)."""
+    try:
+        synced = wallet.chain_sync.sync(wallet.peer_addresses(), lambda: len(wallet.blockchain.chain),
+                                        lambda data, transactions: accept_block(data, transactions)[1])
+        print(f"Synced {synced} blocks from the peers, the chain has {len(wallet.blockchain.chain)} blocks.")
+    finally:
+        sync_lock.release()
+
+
+def start_sync() -> None:
+    """Run sync_chain in the background, unless a sync is already running."""
+    if sync_lock.acquire(blocking=False):
+        threading.Thread(target=sync_chain, daemon=True).start()
+
+
+@api.route('/api/receive_block', methods=['POST'])
+def receive_block():
+    """
+    Receive a block and update hard_state with the transactions contained inside it.
+    """
+    if binary_request():
+        try:
+            data, transactions = decode_block(request.get_data())
+        except DECODE_ERRORS:
+            return jsonify({"error": "Invalid binary payload"}), 400
+    else:
+        data = request.json
+        if data is None:
+            return jsonify({"error": "No JSON data provided"}), 400
+
+        transactions = [deserialize_trans(transaction) for transaction in data['transactions']]
+
+    message, status = accept_block(data, transactions)
+
+    return jsonify(message), status
 
 
-@app.route('/api/stake_amount', methods=['POST', 'GET'])
+@api.route('/api/stake_amount', methods=['POST', 'GET'])
 def stake_amount():
     data = request.json
     amount = data["amount"]
@@ -334,7 +591,7 @@ def stake_amount():
     return jsonify({"message": "Stake successful"}), 200
 
 
-@app.route('/api/make_transaction', methods=['POST'])
+@api.route('/api/make_transaction', methods=['POST'])
 def make_transaction():
     data = request.json
     if data is None:
@@ -350,44 +607,52 @@ def make_transaction():
 
     transaction = wallet.create_transaction(wallet.address, receiver_address, type, amount, message, wallet.nonce)
     if wallet.broadcast_transaction(transaction):
-        return jsonify({"message": "Transaction broadcasted successfully"}), 200
+        return jsonify({"message": "Transaction broadcasted successfully",
+                        "transaction_id": transaction.transaction_id}), 200
     else:
         return jsonify({"message": "Some error occurred"}), 400
 
 
-@app.route('/api/pending_transactions', methods=['GET'])
+@api.route('/api/pending_transactions', methods=['GET'])
 def pending_transactions():
     transactions_list = []
-    for transaction in wallet.transactions_pending.values():
+    for transaction in wallet.mempool.snapshot():
         transactions_list.append(transaction.serialize())
     return jsonify(transactions_list), 200
 
 
-@app.route('/api/rejected_transactions', methods=['GET'])
+@api.route('/api/rejected_transactions', methods=['GET'])
 def rejected_transactions():
+    try:
+        offset, limit = page_args()
+    except ValueError:
+        return jsonify({"error": "Invalid parameter(s)"}), 400
     transactions_list = []
-    for transaction in wallet.transactions_rejected.values():
+    for transaction in wallet.transactions_rejected.page(offset, limit):
         transactions_list.append(transaction.serialize())
     transactions_list.append(len(wallet.transactions_rejected))
     return jsonify(transactions_list), 200
 
 
-@app.route('/api/missing_transactions', methods=['GET'])
+@api.route('/api/missing_transactions', methods=['GET'])
 def missing_transactions():
+    try:
+        offset, limit = page_args()
+    except ValueError:
+        return jsonify({"error": "Invalid parameter(s)"}), 400
     transactions_list = []
-    for transaction in wallet.transactions_missing.values():
+    for transaction in wallet.transactions_missing.page(offset, limit):
         transactions_list.append(transaction.serialize())
     transactions_list.append(len(wallet.transactions_missing))
     return jsonify(transactions_list), 200
 
 
-@app.route('/api/print_block_lengths', methods=['GET'])
-def print_block_lengths():
+def write_block_lengths() -> None:
     file_path = f"{wallet.id}.txt"
     with open(file_path, 'w') as file:
         file.write(f"Blockchain length: {len(wallet.blockchain.chain)}")
         for block in wallet.blockchain.chain:
-            if len(block.transactions) != CAPACITY:
+            if len(block.transactions) != block.capacity:
                 file.write(f"Block length: {len(block.transactions)}")
 
         for block in wallet.blockchain.chain:
@@ -395,49 +660,129 @@ def print_block_lengths():
             for transaction in block.transactions:
                 file.write(f"{transaction.sender_address} - {transaction.nonce}\n")
             file.write("\n")
-        return jsonify({"message": "All good"}), 200
 
 
-if bootstrap:
-    broadcast_thread = threading.Thread(target=broadcast_network_blockchain).start()
+@api.route('/api/print_block_lengths', methods=['GET'])
+def print_block_lengths():
+    write_block_lengths()
+    return jsonify({"message": "All good"}), 200
 
 
-    @app.route('/api/bootstrap/register_node', methods=['POST'])
-    def register_node():
-        data = request.json
-        if data is None:
-            return jsonify({"error": "No JSON data provided"}), 400
+def add_node(data) -> tuple:
+    """Register a node with the bootstrap. Returns the response message and the status code."""
+    if data is None:
+        return {"error": "No JSON data provided"}, 400
 
-        address = data.get('address')
-        public_key = data.get('public_key')
-        if address is None or public_key is None:
-            return jsonify({"error": "Missing parameter(s)"}), 400
+    address = data.get('address')
+    public_key = data.get('public_key')
+    if address is None or public_key is None:
+        return {"error": "Missing parameter(s)"}, 400
 
-        wallet.given_id += 1
-        wallet.register_node(address, public_key)
+    wallet.given_id += 1
+    wallet.register_node(address, public_key)
 
-        if wallet.given_id == TOTAL_NODES - 1:
-            network_full.set()
+    if wallet.given_id == TOTAL_NODES - 1:
+        network_full.set()
 
-        return jsonify({"message": "Node registered successfully", "id": wallet.given_id}), 200
+    return {"message": "Node registered successfully", "id": wallet.given_id}, 200
 
-if not bootstrap:
-    @app.route('/api/regular/receive_state', methods=['POST'])
-    def receive_state():
-        wallet.total_lock.acquire()
-        data = request.get_json()
-        if data is None:
-            wallet.total_lock.release()
-            return jsonify({"error": "No JSON data provided"}), 400
-        wallet.blockchain_state = data
-        wallet.blockchain_state_hard = deepcopy(wallet.blockchain_state)
-        wallet.total_lock.release()
 
-        for node in wallet.blockchain_state.keys():
-            wallet.nonce_sets[node] = set()
+@bootstrap_api.route('/api/bootstrap/register_node', methods=['POST'])
+def register_node():
+    message, status = add_node(request.json)
+    return jsonify(message), status
+
+
+def load_state(data) -> tuple:
+    """
+    Replace the state with the network state sent by the bootstrap and start pulling the chain.
+    Returns the response message and the status code.
+    """
+    if data is None:
+        return {"error": "No JSON data provided"}, 400
+
+    wallet.total_lock.acquire()
+    wallet.state.reset(data)
+    wallet.save_node_info()
+    for node, node_state in wallet.blockchain_state.items():
+        wallet.cache_public_key(node, node_state["public_key"])
+    wallet.nonces.reset(wallet.blockchain_state.keys())
+    wallet.committed_nonces.reset(wallet.blockchain_state.keys())
+    wallet.total_lock.release()
+
+    start_sync()
+
+    return {'message': 'State received and updated successfully'}, 200
+
+
+@node_api.route('/api/regular/receive_state', methods=['POST'])
+def receive_state():
+    message, status = load_state(request.get_json())
+    return jsonify(message), status
+
+
+def init_node(node_ip_address: str, node_port: int) -> None:
+    """
+    Create the node that listens at the given address: its wallet (registering with the bootstrap, or recovering
+    from the block store) and its background threads (the block producer included). Importing this module does nothing, so there is one node
+    per call (and one per process, since the node state is kept in the globals of this module).
+    The routes are served by the Flask app (create_app) or by the asyncio runtime (async_app.py).
+    """
+    global ip_address, port, bootstrap, signature_verifier, wallet, flag
+    ip_address = node_ip_address
+    port = node_port
+    bootstrap = ip_address == BOOTSTRAP_IP and port == BOOTSTRAP_PORT
+
+    # created before anything else, so that the worker processes are forked before the node starts any threads
+    signature_verifier = SignatureVerifier()
+
+    wallet = Wallet(ip_address, port, bootstrap)
+    flag = not wallet.recovered
+    metrics.watch_wallet(wallet)
+    if wallet.blockchain.store is not None:
+        # fsync the blocks that are not synced yet (FSYNC_EVERY > 1) when the node stops
+        atexit.register(wallet.blockchain.store.close)
+
+    if bootstrap and not wallet.recovered:
+        threading.Thread(target=broadcast_network_blockchain).start()
+
+    if wallet.recovered:
+        # catch up with the blocks that were added while this node was down
+        start_sync()
+
+    threading.Thread(target=miner_thread_func, daemon=True).start()
+
+
+def create_app(node_ip_address: str, node_port: int) -> Flask:
+    """Create the node (see init_node) and the Flask app with its routes."""
+    init_node(node_ip_address, node_port)
+
+    app = Flask('BlockChat')
+    app.register_blueprint(api)
+    if bootstrap and not wallet.recovered:
+        app.register_blueprint(bootstrap_api)
+    if not bootstrap:
+        app.register_blueprint(node_api)
+
+    return app
+
+
+def serve(app: Flask) -> None:
+    """Serve the node with waitress (a multi-threaded production server), or with the Flask development server."""
+    if SERVER == "waitress":
+        try:
+            from waitress import serve as waitress_serve
+        except ImportError:
+            print("waitress is not installed (pip install waitress), using the Flask development server.")
+        else:
+            waitress_serve(app, host=ip_address, port=port, threads=SERVER_THREADS,
+                           connection_limit=SERVER_CONNECTION_LIMIT, backlog=SERVER_BACKLOG,
+                           channel_timeout=SERVER_CHANNEL_TIMEOUT, ident="BlockChat")
+            return
+
+    app.run(host=ip_address, port=port, threaded=True)
 
-        return jsonify({'message': 'State received and updated successfully'}), 200
 
 if __name__ == '__main__':
-    miner_thread = threading.Thread(target=miner_thread_func).start()
-    app.run(host=ip_address, port=port)
+    node_app = create_app(sys.argv[1], int(sys.argv[2]))
+    serve(node_app)
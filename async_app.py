@@ -0,0 +1,396 @@
+"""
+The asyncio runtime of the node: the same node as app.py (its Wallet, Block and Transaction logic and its handlers),
+served by aiohttp instead of a thread per request. The broadcasts of the own transactions are awaited with an
+aiohttp client, so a request waiting for the peers does not hold a thread. The work that takes the total_lock or is
+CPU heavy (verifying and signing transactions, applying blocks) runs in a small thread pool, so the event loop
+keeps serving the other requests meanwhile.
+
+Usage: python3 async_app.py <ip> <port>
+"""
+import asyncio
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+from dotenv import load_dotenv
+
+import app as node
+from src.async_network import AsyncPeerPool, AsyncTransactionBatcher
+from src import metrics
+from src.bounded import DEBUG_PAGE_SIZE
+from src.codec import BINARY_CONTENT_TYPE, DECODE_ERRORS, decode_block, decode_transactions, encode_block, encode_blocks
+from src.metrics import BROADCAST_TRANSACTION_SECONDS, timed
+from src.network import GOSSIP_BATCH
+from src.sync import SYNC_CHUNK_SIZE
+from src.transaction import deserialize_trans
+
+load_dotenv()
+ASYNC_WORKERS = int(os.getenv("ASYNC_WORKERS", "4"))  # threads for the locked and CPU heavy work
+MAX_BODY_SIZE = 64 * 1024 * 1024  # bytes, large blocks are sent in one request
+
+# The routes of every node, of the bootstrap only and of the other nodes only (like the blueprints of app.py)
+api = web.RouteTableDef()
+bootstrap_api = web.RouteTableDef()
+node_api = web.RouteTableDef()
+
+# set by create_app
+executor = None
+peers = None
+batcher = None
+
+
+async def run(function, *args):
+    """Run a blocking function in the thread pool of the node."""
+    return await asyncio.get_running_loop().run_in_executor(executor, function, *args)
+
+
+async def json_body(request: web.Request):
+    try:
+        return await request.json()
+    except ValueError:
+        return None
+
+
+def binary_request(request: web.Request) -> bool:
+    """Content negotiation: transactions and blocks can be sent in the compact binary format (see src/codec.py)."""
+    return request.content_type == BINARY_CONTENT_TYPE
+
+
+def page_args(request: web.Request) -> tuple:
+    """The offset and limit query parameters of the paginated debug endpoints (limit at most DEBUG_PAGE_SIZE)."""
+    offset = max(int(request.query.get('offset', 0)), 0)
+    limit = min(max(int(request.query.get('limit', DEBUG_PAGE_SIZE)), 0), DEBUG_PAGE_SIZE)
+    return offset, limit
+
+
+@timed(BROADCAST_TRANSACTION_SECONDS)
+async def send_transaction(transaction) -> bool:
+    """Wallet.broadcast_transaction, with the broadcast awaited instead of blocking a thread."""
+    wallet = node.wallet
+    if not await run(wallet.prepare_transaction, transaction):
+        return False
+
+    nodes = wallet.peer_addresses()
+    if batcher is not None:
+        if not await batcher.submit(nodes, transaction):
+            return False
+    else:
+        payload, headers = wallet.transaction_payload(transaction)
+        results = await peers.broadcast(nodes, "/api/receive_transaction", payload, headers)
+        if not peers.succeeded(nodes, results):
+            return False
+
+    return await run(wallet.add_own_transaction, transaction)
+
+
+def handle_transactions(transactions: list) -> list:
+    """Validate and process received transactions, with the total_lock taken once for all of them."""
+    with node.wallet.total_lock:
+        return [node.handle_transaction(transaction) for transaction in transactions]
+
+
+@api.post('/api/receive_transaction')
+async def receive_transaction(request: web.Request):
+    if binary_request(request):
+        try:
+            transaction = decode_transactions(await request.read())[0]
+        except DECODE_ERRORS:
+            return web.json_response({"error": "Invalid binary payload"}, status=400)
+    else:
+        data = await json_body(request)
+        if data is None:
+            return web.json_response({"error": "No JSON data provided"}, status=400)
+
+        transaction = deserialize_trans(data['transaction'])
+
+    message, status = (await run(handle_transactions, [transaction]))[0]
+
+    if status == 200:
+        node.start_driver()
+
+    return web.json_response(message, status=status)
+
+
+@api.post('/api/receive_transactions')
+async def receive_transactions(request: web.Request):
+    if binary_request(request):
+        try:
+            transactions = decode_transactions(await request.read())
+        except DECODE_ERRORS:
+            return web.json_response({"error": "Invalid binary payload"}, status=400)
+    else:
+        data = await json_body(request)
+        if data is None:
+            return web.json_response({"error": "No JSON data provided"}, status=400)
+
+        transactions = [deserialize_trans(transaction) for transaction in data['transactions']]
+
+    results = []
+    for transaction, (message, status) in zip(transactions, await run(handle_transactions, transactions)):
+        results.append({"transaction_id": transaction.transaction_id, "status": status, **message})
+
+    if any(result["status"] == 200 for result in results):
+        node.start_driver()
+
+    return web.json_response({"results": results})
+
+
+@api.post('/api/receive_block')
+async def receive_block(request: web.Request):
+    if binary_request(request):
+        try:
+            data, transactions = decode_block(await request.read())
+        except DECODE_ERRORS:
+            return web.json_response({"error": "Invalid binary payload"}, status=400)
+    else:
+        data = await json_body(request)
+        if data is None:
+            return web.json_response({"error": "No JSON data provided"}, status=400)
+
+        transactions = [deserialize_trans(transaction) for transaction in data['transactions']]
+
+    message, status = await run(node.accept_block, data, transactions)
+
+    return web.json_response(message, status=status)
+
+
+def blocks_body(start: int, limit: int, binary: bool) -> bytes:
+    height, selected = node.select_blocks(start, limit)
+    if binary:
+        return encode_blocks(height, selected)
+    # The serialized blocks are cached, so they are joined instead of being parsed and encoded again
+    return (f'{{"height": {height}, "blocks": [' + ", ".join(block.serialize() for block in selected) + "]}").encode()
+
+
+@api.get('/api/blocks')
+async def blocks(request: web.Request):
+    """The blocks [from, from + limit) of the chain and the height of the chain (see blocks in app.py)."""
+    try:
+        start = int(request.query.get('from', 0))
+        limit = min(int(request.query.get('limit', SYNC_CHUNK_SIZE)), SYNC_CHUNK_SIZE)
+    except ValueError:
+        return web.json_response({"error": "Invalid parameter(s)"}, status=400)
+    if start < 0 or limit < 0:
+        return web.json_response({"error": "Invalid parameter(s)"}, status=400)
+
+    binary = node.binary_accepted(request.headers.get('Accept'))
+    # blocks that are not cached are read from the block store
+    body = await run(blocks_body, start, limit, binary)
+    return web.Response(body=body, content_type=BINARY_CONTENT_TYPE if binary else 'application/json')
+
+
+def last_block_body(binary: bool) -> bytes:
+    block = node.wallet.blockchain.chain[-1]
+    if binary:
+        return encode_block(block)
+
+    data = json.loads(block.serialize())
+    data["transactions"] = [json.loads(transaction) for transaction in data["transactions"]]
+    return json.dumps(data).encode()
+
+
+@api.get('/api/view_block')
+async def view_block(request: web.Request):
+    binary = node.binary_accepted(request.headers.get('Accept'))
+    # the block may have to be read from the block store
+    body = await run(last_block_body, binary)
+    return web.Response(body=body, content_type=BINARY_CONTENT_TYPE if binary else 'application/json')
+
+
+@api.get('/api/transaction_proof/{transaction_id}')
+async def transaction_proof(request: web.Request):
+    # the block may have to be read from the block store, and the proof hashes its transactions
+    proof = await run(node.wallet.blockchain.transaction_proof, request.match_info['transaction_id'])
+    if proof is None:
+        return web.json_response({"error": "Transaction not found in any block"}, status=404)
+    return web.json_response(proof)
+
+
+@api.route('*', '/api/stake_amount')
+async def stake_amount(request: web.Request):
+    data = await json_body(request)
+    amount = None if data is None else data.get("amount")
+    if amount is None:
+        return web.json_response({"error": "Missing parameter(s)"}, status=400)
+
+    wallet = node.wallet
+    if amount > wallet.balance:
+        print(f"Insufficient balance. You have {wallet.balance} coins. Requested stake: {amount} coins")
+        return web.json_response({"error": "Insufficient balance"}, status=400)
+
+    transaction = wallet.create_transaction(sender_address=wallet.address, receiver_address='0',
+                                            type_of_transaction="coins", amount=amount, message="", nonce=wallet.nonce)
+    if not await send_transaction(transaction):
+        print("Error: Transaction was not broadcasted.")
+        return web.json_response({"error": "Insufficient balance"}, status=400)
+    return web.json_response({"message": "Stake successful"})
+
+
+@api.post('/api/make_transaction')
+async def make_transaction(request: web.Request):
+    data = await json_body(request)
+    if data is None:
+        return web.json_response({"error": "No JSON data provided"}, status=400)
+
+    receiver_address = data['receiver_address']
+    amount = data['amount']
+    message = data['message']
+    type = data['type']
+
+    if receiver_address is None or amount is None:
+        return web.json_response({"error": "Missing parameter(s)"}, status=400)
+
+    wallet = node.wallet
+    transaction = wallet.create_transaction(wallet.address, receiver_address, type, amount, message, wallet.nonce)
+    if await send_transaction(transaction):
+        return web.json_response({"message": "Transaction broadcasted successfully",
+                                  "transaction_id": transaction.transaction_id})
+    else:
+        return web.json_response({"message": "Some error occurred"}, status=400)
+
+
+@api.get('/api/get_balance')
+async def get_balance(request: web.Request):
+    return web.json_response({"balance": node.wallet.balance})
+
+
+@api.get('/api/get_network_state')
+async def get_network_state(request: web.Request):
+    return web.json_response(node.wallet.state.snapshot())
+
+
+@api.get('/api/get_network_state_hard')
+async def get_network_state_hard(request: web.Request):
+    return web.json_response(node.wallet.state.snapshot(hard=True))
+
+
+@api.get('/api/pending_transactions')
+async def pending_transactions(request: web.Request):
+    return web.json_response([transaction.serialize() for transaction in node.wallet.mempool.snapshot()])
+
+
+def transaction_page(request: web.Request, collection, with_size=True):
+    try:
+        offset, limit = page_args(request)
+    except ValueError:
+        return web.json_response({"error": "Invalid parameter(s)"}, status=400)
+    transactions_list = [transaction.serialize() for transaction in collection.page(offset, limit)]
+    if with_size:
+        transactions_list.append(len(collection))
+    return web.json_response(transactions_list)
+
+
+@api.get('/api/rejected_transactions')
+async def rejected_transactions(request: web.Request):
+    return transaction_page(request, node.wallet.transactions_rejected)
+
+
+@api.get('/api/missing_transactions')
+async def missing_transactions(request: web.Request):
+    return transaction_page(request, node.wallet.transactions_missing)
+
+
+# For debugging purposes
+@api.get('/api/transactions_history')
+async def transactions_history(request: web.Request):
+    return transaction_page(request, node.wallet.transaction_history, with_size=False)
+
+
+# For debugging purposes
+@api.get('/api/debug_collections')
+async def debug_collections(request: web.Request):
+    wallet = node.wallet
+    return web.json_response({"transaction_history": wallet.transaction_history.stats(),
+                              "transactions_rejected": wallet.transactions_rejected.stats(),
+                              "transactions_missing": wallet.transactions_missing.stats()})
+
+
+# For debugging purposes
+@api.get('/api/transaction_counts')
+async def transaction_counts(request: web.Request):
+    wallet = node.wallet
+    return web.json_response({"sent": wallet.nonce, "received": wallet.received_transactions_count,
+                              "accepted": wallet.accepted_transactions_count})
+
+
+# For debugging purposes
+@api.get('/api/verified_cache')
+async def verified_cache(request: web.Request):
+    return web.json_response(node.wallet.verified_cache.stats())
+
+
+# For debugging purposes
+@api.get('/api/block_delivery_status')
+async def block_delivery_status(request: web.Request):
+    return web.json_response(node.wallet.block_delivery.get_status())
+
+
+# For debugging purposes
+@api.get('/api/block_capacity')
+async def block_capacity(request: web.Request):
+    return web.json_response(node.wallet.block_capacity.stats())
+
+
+@api.get('/metrics')
+async def metrics_endpoint(request: web.Request):
+    """The metrics of the node in the Prometheus text format (see src/metrics.py)."""
+    if not metrics.METRICS:
+        return web.json_response({"error": "Metrics are disabled"}, status=404)
+    return web.Response(text=metrics.render(), headers={'Content-Type': metrics.CONTENT_TYPE})
+
+
+@api.get('/api/print_block_lengths')
+async def print_block_lengths(request: web.Request):
+    await run(node.write_block_lengths)
+    return web.json_response({"message": "All good"})
+
+
+@bootstrap_api.post('/api/bootstrap/register_node')
+async def register_node(request: web.Request):
+    message, status = node.add_node(await json_body(request))
+    return web.json_response(message, status=status)
+
+
+@node_api.post('/api/regular/receive_state')
+async def receive_state(request: web.Request):
+    message, status = await run(node.load_state, await json_body(request))
+    return web.json_response(message, status=status)
+
+
+async def start_peers(app: web.Application) -> None:
+    await peers.start()
+    if batcher is not None:
+        batcher.start()
+
+
+async def close_peers(app: web.Application) -> None:
+    await peers.close()
+
+
+def create_app(node_ip_address: str, node_port: int) -> web.Application:
+    """Create the node (see init_node in app.py) and the aiohttp app with its routes."""
+    global executor, peers, batcher
+    node.init_node(node_ip_address, node_port)
+
+    executor = ThreadPoolExecutor(max_workers=ASYNC_WORKERS, thread_name_prefix="node")
+    peers = AsyncPeerPool()
+    batcher = AsyncTransactionBatcher(peers) if GOSSIP_BATCH else None
+
+    app = web.Application(client_max_size=MAX_BODY_SIZE)
+    app.add_routes(api)
+    if node.bootstrap and not node.wallet.recovered:
+        app.add_routes(bootstrap_api)
+    if not node.bootstrap:
+        app.add_routes(node_api)
+    app.on_startup.append(start_peers)
+    app.on_cleanup.append(close_peers)
+
+    return app
+
+
+if __name__ == '__main__':
+    node_app = create_app(sys.argv[1], int(sys.argv[2]))
+    web.run_app(node_app, host=node.ip_address, port=node.port, backlog=node.SERVER_BACKLOG,
+                keepalive_timeout=node.SERVER_CHANNEL_TIMEOUT, access_log=None)
@@ -0,0 +1,53 @@
+"""
+Measures the sustained request throughput of a running node, e.g. to compare the production server (SERVER=waitress)
+with the Flask development server (SERVER=dev). Every client is a separate process (so the benchmark itself is not
+limited by the GIL) that keeps one keep-alive connection.
+
+Usage: python3 bench.py <ip:port> [clients] [seconds] [path]
+"""
+import multiprocessing
+import sys
+import time
+import requests
+
+if len(sys.argv) < 2:
+    print("Usage: python3 bench.py <ip:port> [clients] [seconds] [path]")
+    sys.exit(1)
+
+address = sys.argv[1]
+clients = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+seconds = float(sys.argv[3]) if len(sys.argv) > 3 else 10
+path = sys.argv[4] if len(sys.argv) > 4 else "/api/get_balance"
+
+
+
+def client(deadline: float) -> tuple:
+    session = requests.Session()
+    latencies = []
+    errors = 0
+    while time.time() < deadline:
+        start = time.time()
+        try:
+            response = session.get(f"http://{address}{path}", timeout=10)
+            if response.status_code != 200:
+                errors += 1
+        except requests.exceptions.RequestException:
+            errors += 1
+        latencies.append(time.time() - start)
+    return latencies, errors
+
+
+if __name__ == '__main__':
+    deadline = time.time() + seconds
+    with multiprocessing.Pool(clients) as pool:
+        results = pool.map(client, [deadline] * clients)
+
+    latencies = sorted(latency for result in results for latency in result[0])
+    errors = sum(result[1] for result in results)
+    if not latencies:
+        print("No requests were completed.")
+        sys.exit(1)
+    print(f"{len(latencies)} requests in {seconds} s with {clients} clients ({errors} errors)")
+    print(f"Throughput: {len(latencies) / seconds:.1f} requests/s")
+    print(f"Latency: p50 {latencies[len(latencies) // 2] * 1000:.2f} ms, "
+          f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:.2f} ms")
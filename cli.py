@@ -1,7 +1,13 @@
 import argparse
+import hashlib
 import requests
 import json
 
+from src.merkle import verify_proof
+
+# the fields of the block header, in the order they are hashed
+HEADER_FIELDS = ["index", "timestamp", "merkle_root", "validator", "capacity", "previous_hash"]
+
 
 def new_transaction(args, base_address):
     data = {
@@ -74,6 +80,29 @@ def balance(base_address):
     print("Wallet balance :", data['balance'])
 
 
+def proof(args, base_address):
+    response = requests.get(f"{base_address}/transaction_proof/{args.transaction_id}",
+                            headers={'Content-Type': 'application/json'})
+    if response.status_code != 200:
+        print("Error:", response)
+        return
+    data = response.json()
+
+    # Check the Merkle path up to the root (leaves and nodes are hashed with different prefixes, and a node
+    # without a sibling is promoted without a step, see src/merkle.py), and that the header with this root
+    # hashes to the block hash
+    header = {field: data["header"][field] for field in HEADER_FIELDS}
+    header_hash = hashlib.sha256(json.dumps(header).encode('utf-8')).hexdigest()
+    if json.loads(data["transaction"])["transaction_id"] != args.transaction_id:
+        print("Invalid proof: it is for a different transaction")
+    elif not verify_proof(data["transaction"], data["proof"], header["merkle_root"]):
+        print("Invalid proof: the Merkle path does not lead to the root of the block")
+    elif header_hash != data["current_hash"]:
+        print("Invalid proof: the header does not match the block hash")
+    else:
+        print(f"Transaction is included in block {header['index']} ({data['current_hash']})")
+
+
 def help():
     print("Usage:")
     print("  t <recipient_address> <amount>  : New transaction")
@@ -81,6 +110,7 @@ def help():
     print("  stake <amount>                  : Set the node stake")
     print("  view                            : View last block")
     print("  balance                         : Show balance")
+    print("  proof <transaction_id>          : Verify that a transaction is included in a block")
 
 
 def main():
@@ -104,6 +134,9 @@ def main():
     parser_s = subparsers.add_parser('stake', help='Stake amount')
     parser_s.add_argument('amount', type=int, help='Amount for staking')
 
+    parser_p = subparsers.add_parser('proof', help='Verify the inclusion of a transaction')
+    parser_p.add_argument('transaction_id', type=str, help='Transaction ID')
+
     parser_h = subparsers.add_parser('help', help='Show help')
 
     args = parser.parse_args()
@@ -122,6 +155,8 @@ def main():
         balance(base_address)
     elif args.command == 'stake':
         stake(args, base_address)
+    elif args.command == 'proof':
+        proof(args, base_address)
     else:
         print('Invalid command')
 
@@ -0,0 +1,151 @@
+import asyncio
+import json
+import time
+
+import aiohttp
+
+from src.codec import JSON_HEADERS
+from src.metrics import BROADCAST_BATCH_SECONDS, observe_peer_request, timed
+from src.network import (BROADCAST_POLICY, BROADCAST_TIMEOUT, BROADCAST_WORKERS, GOSSIP_BATCH_SIZE,
+                         GOSSIP_BATCH_WINDOW, batch_accepted, batch_payload, broadcast_succeeded)
+
+
+class PeerResponse:
+    """
+    The status and body of a response from a peer. The body is read before the connection goes back to the pool,
+    and the object can be used like a requests.Response (status_code, json()).
+    """
+
+    def __init__(self, status_code: int, body: bytes) -> None:
+        self.status_code = status_code
+        self.body = body
+
+    def json(self):
+        return json.loads(self.body)
+
+
+class AsyncPeerPool:
+    """
+    The asyncio counterpart of PeerPool: one aiohttp session that keeps up to BROADCAST_WORKERS keep-alive
+    connections per peer. A broadcast awaits the requests to all the peers together, so the requests in flight
+    do not need a thread each. The session is created by start, in the event loop that uses it.
+    """
+
+    def __init__(self, policy=BROADCAST_POLICY, timeout=BROADCAST_TIMEOUT, limit_per_host=BROADCAST_WORKERS) -> None:
+        if policy not in ["all", "quorum", "any"]:
+            raise ValueError("Invalid broadcast policy. It should be 'all', 'quorum' or 'any'.")
+
+        self.policy = policy
+        self.timeout = timeout
+        self.limit_per_host = limit_per_host
+        self.session = None
+
+    async def start(self) -> None:
+        connector = aiohttp.TCPConnector(limit=0, limit_per_host=self.limit_per_host)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout))
+
+    async def close(self) -> None:
+        if self.session is not None:
+            await self.session.close()
+
+    async def post(self, node: str, path: str, payload, headers=None):
+        """
+        POST the payload to a single peer. Returns the response, or None if the peer could not be reached
+        (connection error or timeout).
+        """
+        if headers is None:
+            headers = JSON_HEADERS
+        start = time.perf_counter()
+        try:
+            async with self.session.post(f"http://{node}{path}", data=payload, headers=headers) as response:
+                result = PeerResponse(response.status, await response.read())
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"Error: could not reach {node}: {e!r}")
+            result = None
+        observe_peer_request(node, path, time.perf_counter() - start, None if result is None else result.status_code)
+        return result
+
+    async def get(self, node: str, path: str, params=None, headers=None):
+        """GET from a single peer. Returns the response, or None if the peer could not be reached."""
+        start = time.perf_counter()
+        try:
+            async with self.session.get(f"http://{node}{path}", params=params, headers=headers) as response:
+                result = PeerResponse(response.status, await response.read())
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"Error: could not reach {node}: {e!r}")
+            result = None
+        observe_peer_request(node, path, time.perf_counter() - start, None if result is None else result.status_code)
+        return result
+
+    async def broadcast(self, nodes: list, path: str, payload, headers=None) -> dict:
+        """Send the payload to every node at once and return a dictionary {node: response or None}."""
+        responses = await asyncio.gather(*(self.post(node, path, payload, headers) for node in nodes))
+        return dict(zip(nodes, responses))
+
+    def succeeded(self, nodes: list, results: dict) -> bool:
+        """Decide, according to the partial failure policy, if a broadcast to the given nodes was successful."""
+        return broadcast_succeeded(self.policy, nodes, results)
+
+
+class AsyncTransactionBatcher:
+    """
+    The asyncio counterpart of TransactionBatcher: outgoing transactions are queued and sent in batches to
+    /api/receive_transactions by a task of the event loop, which is started by start.
+    """
+
+    def __init__(self, peers: AsyncPeerPool, max_size=GOSSIP_BATCH_SIZE, window=GOSSIP_BATCH_WINDOW) -> None:
+        self.peers = peers
+        self.max_size = max_size
+        self.window = window
+        self.queue = asyncio.Queue()  # of (nodes, signed transaction, asyncio.Future)
+        self.task = None
+
+    def start(self) -> None:
+        self.task = asyncio.get_running_loop().create_task(self.flusher())
+
+    def submit(self, nodes: list, transaction) -> asyncio.Future:
+        """Queue a signed transaction. The returned future resolves to True if the broadcast succeeded."""
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((nodes, transaction, future))
+        return future
+
+    async def collect(self) -> list:
+        batch = [await self.queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.window
+        while len(batch) < self.max_size:
+            try:
+                remaining = deadline - loop.time()
+                if remaining > 0:
+                    batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+                else:
+                    batch.append(self.queue.get_nowait())
+            except (asyncio.TimeoutError, asyncio.QueueEmpty):
+                break
+        return batch
+
+    async def flusher(self) -> None:
+        while True:
+            batch = await self.collect()
+            # transactions are normally sent to the same peers, but group them by peer list to be safe
+            groups = {}
+            for nodes, transaction, future in batch:
+                groups.setdefault(tuple(nodes), []).append((transaction, future))
+            for nodes, items in groups.items():
+                try:
+                    await self.send(list(nodes), items)
+                except Exception as e:
+                    print("Error: batch broadcast failed:", e)
+                    for _, future in items:
+                        if not future.done():
+                            future.set_result(False)
+
+    @timed(BROADCAST_BATCH_SECONDS)
+    async def send(self, nodes: list, items: list) -> None:
+        payload, headers = batch_payload([transaction for transaction, _ in items])
+        results = await self.peers.broadcast(nodes, "/api/receive_transactions", payload, headers)
+
+        for (_, future), ok in zip(items, batch_accepted(self.peers.policy, nodes, results, len(items))):
+            # the request that submitted the transaction may have been cancelled in the meantime
+            if not future.done():
+                future.set_result(ok)
@@ -6,38 +6,92 @@ from Crypto.Hash.SHA256 import SHA256Hash
 from Crypto.Hash import SHA256
 
 from src.blockchain import Blockchain
+from src.merkle import leaf_hash, merkle_root, merkle_proof
+from src.capacity import CAPACITY, capacity_allowed
 
-from dotenv import load_dotenv
 
-load_dotenv(os.path.join(os.path.dirname(__file__), '..', '.env'))
-CAPACITY = int(os.getenv("CAPACITY"))
+# fields that are part of the hash of the block, and fields that are serialized
+HASHED_FIELDS = {"index", "timestamp", "transactions", "validator", "capacity", "previous_hash"}
+SERIALIZED_FIELDS = HASHED_FIELDS | {"current_hash"}
 
 
 class Block:
+    """
+    The hash of a block is the hash of its header, which commits to the transactions through their Merkle root,
+    so the inclusion of a transaction can be proven with O(log n) hashes (see src/merkle.py).
+
+    The canonical JSON, the hash and the serialized form of a block are computed once and cached, and every
+    transaction is serialized only once for all of them. Setting one of the fields drops the cached values that
+    depend on it (the list of transactions must be replaced, not changed in place).
+
+    The capacity chosen by the validator for the block (see src/capacity.py) is part of the header.
+    """
 
     def __init__(self, index: int, timestamp: datetime, transactions: list, validator: int,
-                 previous_hash: str) -> None:
+                 previous_hash: str, capacity=CAPACITY) -> None:
         self.index = index
         self.timestamp = timestamp
         self.transactions = transactions
         self.validator = validator
+        self.capacity = capacity
         self.previous_hash = previous_hash
         self.current_hash = self.hash_block().hexdigest()
 
-    def stringify(self) -> str:
-        block = {
+    def __setattr__(self, name, value) -> None:
+        super().__setattr__(name, value)
+        if name in SERIALIZED_FIELDS:
+            self.__dict__.pop("_serialized", None)
+            if name in HASHED_FIELDS:
+                self.__dict__.pop("_stringified", None)
+                self.__dict__.pop("_hash", None)
+            if name == "transactions":
+                self.__dict__.pop("_leaves", None)
+                self.__dict__.pop("_merkle_root", None)
+
+    def leaves(self) -> list:
+        cached = self.__dict__.get("_leaves")
+        if cached is None:
+            cached = [leaf_hash(transaction.serialize()) for transaction in self.transactions]
+            self.__dict__["_leaves"] = cached
+        return cached
+
+    def merkle_root(self) -> str:
+        cached = self.__dict__.get("_merkle_root")
+        if cached is None:
+            cached = merkle_root(self.leaves()).hex()
+            self.__dict__["_merkle_root"] = cached
+        return cached
+
+    def merkle_proof(self, position: int) -> list:
+        """The inclusion proof of the transaction at the given position of the block."""
+        return merkle_proof(self.leaves(), position)
+
+    def header(self) -> dict:
+        return {
             "index": self.index,
             "timestamp": self.timestamp,
-            "transactions": list(map(lambda transaction: transaction.serialize(), self.transactions)),
+            "merkle_root": self.merkle_root(),
             "validator": self.validator,
+            "capacity": self.capacity,
             "previous_hash": self.previous_hash
         }
-        return json.dumps(block)
+
+    def stringify(self) -> str:
+        cached = self.__dict__.get("_stringified")
+        if cached is not None:
+            return cached
+
+        self.__dict__["_stringified"] = json.dumps(self.header())
+        return self.__dict__["_stringified"]
 
     def hash_block(self) -> SHA256Hash:
-        serialized_block = self.stringify().encode('utf-8')
-        sha256_hash_object = SHA256.new(serialized_block)
-        return sha256_hash_object
+        cached = self.__dict__.get("_hash")
+        if cached is None:
+            serialized_block = self.stringify().encode('utf-8')
+            cached = SHA256.new(serialized_block)
+            self.__dict__["_hash"] = cached
+        # a copy, so that the cached hash object cannot be updated by the caller
+        return cached.copy()
 
     def validate_block(self, blockchain: Blockchain, validator: int) -> bool:
         # For the genesis block we don't need to validate.
@@ -57,6 +111,17 @@ class Block:
             print(f"[INVALID BLOCK]: Current hash field is not equal to the hash of the block.")
             return False
 
+        # Verify the capacity of the block
+        if not capacity_allowed(self.capacity) or len(self.transactions) > self.capacity:
+            print(f"[INVALID BLOCK]: Capacity {self.capacity} is not allowed or the block has more transactions "
+                  f"({len(self.transactions)}).")
+            return False
+
+        # A transaction can be contained only once, otherwise it would be committed to the hard state twice
+        if len({transaction.transaction_id for transaction in self.transactions}) != len(self.transactions):
+            print(f"[INVALID BLOCK]: The block contains the same transaction more than once.")
+            return False
+
         # Verify the winner of the block
         if self.validator != validator:
             print(f"[INVALID BLOCK]: Validator field is not equal to the validator calculated."
@@ -67,22 +132,23 @@ class Block:
         return True
 
     def serialize(self) -> str:
+        cached = self.__dict__.get("_serialized")
+        if cached is not None:
+            return cached
+
         block = {
             "index": self.index,
             "timestamp": self.timestamp,
             "transactions": list(map(lambda transaction: transaction.serialize(), self.transactions)),
+            "merkle_root": self.merkle_root(),
             "validator": self.validator,
+            "capacity": self.capacity,
             "previous_hash": self.previous_hash,
             "current_hash": self.current_hash
         }
-        return json.dumps(block)
+        self.__dict__["_serialized"] = json.dumps(block)
+        return self.__dict__["_serialized"]
 
     def calculate_reward(self) -> float:
-        reward = 0
-        for transaction in self.transactions:
-            if (transaction.type_of_transaction == "coins" and transaction.sender_address != "0"
-                and transaction.message != "Initial Transaction") and transaction.receiver_address != '0':
-                reward += transaction.amount * 0.03
-            elif transaction.type_of_transaction == "message":
-                reward += len(transaction.message)
-        return round(reward, 3)
+        # the validator gets exactly the fees the senders paid (see Transaction.fee)
+        return round(sum(transaction.fee() for transaction in self.transactions), 3)
@@ -1,4 +1,5 @@
 import threading
+from collections import OrderedDict
 from dotenv import load_dotenv
 import os
 
@@ -6,10 +7,58 @@ load_dotenv(os.path.join(os.path.dirname(__file__), '..', '.env'))
 CAPACITY = int(os.getenv("CAPACITY"))
 
 
+class StoredChain:
+    """
+    A list of blocks where the first `offset` blocks are not kept in memory but read from the block store
+    when needed (e.g. after starting from a snapshot), with a small cache of the recently read ones.
+    """
+
+    def __init__(self, offset: int, load_block, max_cached=64) -> None:
+        self.offset = offset
+        self.load_block = load_block  # function that reads the block at a height from the store
+        self.blocks = []
+        self.cache = OrderedDict()
+        self.max_cached = max_cached
+        self.cache_lock = threading.Lock()  # the blocks are read by the request threads too
+
+    def __len__(self) -> int:
+        return self.offset + len(self.blocks)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("chain index out of range")
+        if index >= self.offset:
+            return self.blocks[index - self.offset]
+
+        with self.cache_lock:
+            block = self.cache.get(index)
+            if block is None:
+                block = self.load_block(index)
+                self.cache[index] = block
+                while len(self.cache) > self.max_cached:
+                    self.cache.popitem(last=False)
+        return block
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def append(self, block) -> None:
+        self.blocks.append(block)
+
+
 class Blockchain:
-    def __init__(self) -> None:
+    def __init__(self, store=None) -> None:
         self.chain = []
+        # optional BlockStore, where every added block is also appended
+        self.store = store
         self.lock = threading.Lock()
+        # {transaction_id: (block index, position in the block)}, for the inclusion proofs
+        self.transaction_index = {}
 
     def view_block(self) -> None:
         if len(self.chain) == 0:
@@ -22,11 +71,32 @@ class Blockchain:
             print(tran)
         return
 
-    def add_block(self, block) -> None:
+    def add_block(self, block, persist=True) -> None:
         self.lock.acquire()
+        if persist and self.store is not None:
+            self.store.append(block)
         self.chain.append(block)
+        for position, transaction in enumerate(block.transactions):
+            self.transaction_index[transaction.transaction_id] = (block.index, position)
         self.lock.release()
 
+    def transaction_proof(self, transaction_id: str):
+        """
+        The proof that a transaction is contained in the chain: the header of its block, the transaction and
+        the Merkle path from the transaction to the root of the header. None if the transaction is not in a block.
+        """
+        location = self.transaction_index.get(transaction_id)
+        if location is None:
+            return None
+        block = self.chain[location[0]]
+        return {
+            "header": block.header(),
+            "current_hash": block.current_hash,
+            "transaction": block.transactions[location[1]].serialize(),
+            "position": location[1],
+            "proof": block.merkle_proof(location[1])
+        }
+
     def validate_chain(self) -> bool:
         curr_index = 0  # genesis block is handled in validate_block
 
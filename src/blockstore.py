@@ -0,0 +1,275 @@
+import json
+import os
+import struct
+import threading
+import zlib
+
+from src.codec import encode_block, decode_block
+
+from dotenv import load_dotenv
+
+load_dotenv(os.path.join(os.path.dirname(__file__), '..', '.env'))
+BLOCK_STORE = int(os.getenv("BLOCK_STORE", "0"))  # 1 to keep the blockchain on disk
+BLOCK_STORE_DIR = os.getenv("BLOCK_STORE_DIR", "data")
+SEGMENT_SIZE = int(os.getenv("SEGMENT_SIZE", str(64 * 1024 * 1024)))  # bytes per segment file
+FSYNC_EVERY = int(os.getenv("FSYNC_EVERY", "1"))  # fsync after this many blocks, 0 to leave it to the OS
+SNAPSHOT_EVERY = int(os.getenv("SNAPSHOT_EVERY", "100"))  # snapshot of the state every this many blocks, 0 for none
+SNAPSHOT_KEEP = int(os.getenv("SNAPSHOT_KEEP", "2"))  # number of snapshots kept
+
+RECORD_HEADER = struct.Struct("<II")  # length and crc32 of the encoded block
+INDEX_ENTRY = struct.Struct("<IQI")  # segment number, offset and length of the record
+
+
+def remove_file(path: str) -> None:
+    """Remove a file that may have been removed already (e.g. an old snapshot pruned by another writer)."""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class BlockStore:
+    """
+    Append-only store of the blocks of a node on local disk.
+
+    Blocks are encoded with the binary codec and appended to segment files (segment-000000.log, ...), each record
+    being a (length, crc32) header followed by the block. The index file has one fixed-size entry per height with
+    the segment and the offset of the block, so any block can be read with one seek. On opening, every record is
+    checked against its crc32: the first record that was not completely written (e.g. because of a crash) or is
+    corrupted is dropped with the ones after it, and the index is completed from the segments.
+    node.json keeps what the node needs to rejoin the network (its keys, its id and the registered nodes), and the
+    snapshot-<height>.json files keep the state after that many blocks, so that only the blocks after the newest
+    snapshot have to be replayed.
+    """
+
+    def __init__(self, directory: str, segment_size=SEGMENT_SIZE, fsync_every=FSYNC_EVERY) -> None:
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync_every = fsync_every
+        self.lock = threading.Lock()
+        self.snapshot_lock = threading.Lock()  # the snapshots are written by background threads, one at a time
+        self.entries = []  # [(segment, offset, length)] by height
+        self.unsynced = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self.recover()
+
+        self.segment = self.entries[-1][0] if self.entries else 0
+        self.segment_file = open(self.segment_path(self.segment), "ab")
+        self.index_file = open(os.path.join(self.directory, "index"), "ab")
+
+    def segment_path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"segment-{segment:06d}.log")
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def recover(self) -> None:
+        """Load the index, drop incomplete records and index the records that were written after the last entry."""
+        index_path = os.path.join(self.directory, "index")
+        data = b""
+        if os.path.exists(index_path):
+            with open(index_path, "rb") as file:
+                data = file.read()
+        data = data[:len(data) - len(data) % INDEX_ENTRY.size]
+        self.entries = [INDEX_ENTRY.unpack_from(data, i) for i in range(0, len(data), INDEX_ENTRY.size)]
+
+        # keep the entries up to the first one whose record is incomplete or corrupted
+        files = {}
+        try:
+            for height, (segment, offset, length) in enumerate(self.entries):
+                if segment not in files:
+                    path = self.segment_path(segment)
+                    files[segment] = open(path, "rb") if os.path.exists(path) else None
+                if files[segment] is None or not self.valid_record(files[segment], offset, length):
+                    self.entries = self.entries[:height]
+                    break
+        finally:
+            for file in files.values():
+                if file is not None:
+                    file.close()
+
+        # scan for complete records after the last indexed one
+        segment, offset = 0, 0
+        if self.entries:
+            segment, offset, length = self.entries[-1]
+            offset += RECORD_HEADER.size + length
+        while os.path.exists(self.segment_path(segment)):
+            path = self.segment_path(segment)
+            with open(path, "rb") as file:
+                file.seek(offset)
+                while True:
+                    header = file.read(RECORD_HEADER.size)
+                    if len(header) < RECORD_HEADER.size:
+                        break
+                    length, crc = RECORD_HEADER.unpack(header)
+                    payload = file.read(length)
+                    if len(payload) < length or zlib.crc32(payload) != crc:
+                        break
+                    self.entries.append((segment, offset, length))
+                    offset += RECORD_HEADER.size + length
+
+            if os.path.getsize(path) > offset:
+                # cut the incomplete record, and the segments after it (their heights would not follow)
+                with open(path, "r+b") as file:
+                    file.truncate(offset)
+                later = segment + 1
+                while os.path.exists(self.segment_path(later)):
+                    os.remove(self.segment_path(later))
+                    later += 1
+                break
+            segment, offset = segment + 1, 0
+
+        self.write_index()
+        self.remove_snapshots_after(len(self.entries))
+
+    @staticmethod
+    def valid_record(file, offset: int, length: int) -> bool:
+        """True if the record at the offset is complete, has the indexed length and matches its crc32."""
+        file.seek(offset)
+        header = file.read(RECORD_HEADER.size)
+        if len(header) < RECORD_HEADER.size:
+            return False
+        stored_length, crc = RECORD_HEADER.unpack(header)
+        if stored_length != length:
+            return False
+        payload = file.read(length)
+        return len(payload) == length and zlib.crc32(payload) == crc
+
+    def write_index(self) -> None:
+        with open(os.path.join(self.directory, "index"), "wb") as file:
+            for entry in self.entries:
+                file.write(INDEX_ENTRY.pack(*entry))
+            file.flush()
+            os.fsync(file.fileno())
+
+    def append(self, block) -> None:
+        payload = encode_block(block)
+        with self.lock:
+            offset = self.segment_file.tell()
+            if offset > 0 and offset + RECORD_HEADER.size + len(payload) > self.segment_size:
+                self.sync()
+                self.segment_file.close()
+                self.segment += 1
+                self.segment_file = open(self.segment_path(self.segment), "ab")
+                offset = 0
+
+            self.segment_file.write(RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+            self.segment_file.flush()
+            self.index_file.write(INDEX_ENTRY.pack(self.segment, offset, len(payload)))
+            self.index_file.flush()
+            self.entries.append((self.segment, offset, len(payload)))
+
+            self.unsynced += 1
+            if self.fsync_every and self.unsynced >= self.fsync_every:
+                self.sync()
+
+    def sync(self) -> None:
+        os.fsync(self.segment_file.fileno())
+        os.fsync(self.index_file.fileno())
+        self.unsynced = 0
+
+    def read(self, height: int) -> tuple:
+        """Read the block at the given height, as the (fields, transactions) returned by codec.decode_block."""
+        segment, offset, length = self.entries[height]
+        with open(self.segment_path(segment), "rb") as file:
+            file.seek(offset + RECORD_HEADER.size)
+            return decode_block(file.read(length))
+
+    def clear(self) -> None:
+        """Delete all the blocks (e.g. when the stored blocks belong to a node that never joined a network)."""
+        with self.lock:
+            self.segment_file.close()
+            self.index_file.close()
+            for name in os.listdir(self.directory):
+                if name.startswith("segment-") or name == "index":
+                    os.remove(os.path.join(self.directory, name))
+            self.entries = []
+            self.unsynced = 0
+            self.segment = 0
+            self.segment_file = open(self.segment_path(self.segment), "ab")
+            self.index_file = open(os.path.join(self.directory, "index"), "ab")
+
+    def truncate(self, height: int) -> None:
+        """
+        Delete the blocks from the given height onward (e.g. a corrupted block and the ones after it), so that the
+        next block is appended at this height, and the snapshots taken after more than `height` blocks.
+        """
+        with self.lock:
+            self.segment_file.close()
+            self.index_file.close()
+            self.entries = self.entries[:height]
+
+            segment, offset = 0, 0
+            if self.entries:
+                segment, offset, length = self.entries[-1]
+                offset += RECORD_HEADER.size + length
+            if os.path.exists(self.segment_path(segment)):
+                with open(self.segment_path(segment), "r+b") as file:
+                    file.truncate(offset)
+            later = segment + 1
+            while os.path.exists(self.segment_path(later)):
+                os.remove(self.segment_path(later))
+                later += 1
+            self.write_index()
+
+            self.unsynced = 0
+            self.segment = segment
+            self.segment_file = open(self.segment_path(self.segment), "ab")
+            self.index_file = open(os.path.join(self.directory, "index"), "ab")
+
+        self.remove_snapshots_after(height)
+
+    def remove_snapshots_after(self, height: int) -> None:
+        """Delete the snapshots taken after more than `height` blocks (they do not match the stored blocks)."""
+        for path in self.snapshot_paths():
+            if int(os.path.basename(path)[len("snapshot-"):-len(".json")]) > height:
+                remove_file(path)
+
+    def close(self) -> None:
+        with self.lock:
+            self.sync()
+            self.segment_file.close()
+            self.index_file.close()
+
+    def save_meta(self, meta: dict) -> None:
+        path = os.path.join(self.directory, "node.json")
+        with open(path + ".tmp", "w") as file:
+            json.dump(meta, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(path + ".tmp", path)
+
+    def load_meta(self):
+        path = os.path.join(self.directory, "node.json")
+        if not os.path.exists(path):
+            return None
+        with open(path) as file:
+            return json.load(file)
+
+    def save_snapshot(self, height: int, snapshot: dict) -> None:
+        """Write the snapshot of the state after `height` blocks and delete the oldest snapshots."""
+        path = os.path.join(self.directory, f"snapshot-{height:010d}.json")
+        with self.snapshot_lock:
+            with open(path + ".tmp", "w") as file:
+                json.dump(snapshot, file)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(path + ".tmp", path)
+
+            for old in self.snapshot_paths()[SNAPSHOT_KEEP:]:
+                remove_file(old)
+
+    def snapshot_paths(self) -> list:
+        """The paths of the snapshots, newest first."""
+        names = [name for name in os.listdir(self.directory) if name.startswith("snapshot-") and name.endswith(".json")]
+        return [os.path.join(self.directory, name) for name in sorted(names, reverse=True)]
+
+    def load_snapshots(self):
+        """Yield the stored snapshots, newest first."""
+        for path in self.snapshot_paths():
+            try:
+                with open(path) as file:
+                    yield json.load(file)
+            except (OSError, ValueError):
+                print(f"Snapshot {path} could not be read, skipping it.")
@@ -0,0 +1,81 @@
+import threading
+import time
+from collections import OrderedDict
+from itertools import islice
+
+from dotenv import load_dotenv
+import os
+
+load_dotenv(os.path.join(os.path.dirname(__file__), '..', '.env'))
+DEBUG_MAX_SIZE = int(os.getenv("DEBUG_MAX_SIZE", "10000"))  # entries kept in each debug collection, 0 for no limit
+DEBUG_MAX_AGE = float(os.getenv("DEBUG_MAX_AGE", "3600"))  # seconds an entry is kept, 0 for no limit
+DEBUG_PAGE_SIZE = int(os.getenv("DEBUG_PAGE_SIZE", "100"))  # max entries per page of the debug endpoints
+
+
+class BoundedDict:
+    """
+    A dictionary that keeps at most max_size entries, each for at most max_age seconds. Entries are kept in
+    insertion order, so the oldest ones are evicted first, and the evictions are counted.
+    All the methods take self.lock, so the debug endpoints can read it while the node changes it.
+    """
+
+    def __init__(self, max_size=DEBUG_MAX_SIZE, max_age=DEBUG_MAX_AGE) -> None:
+        self.max_size = max_size
+        self.max_age = max_age
+        self.entries = OrderedDict()  # {key: (insertion time, value)}
+        self.evicted_size = 0
+        self.evicted_age = 0
+        self.lock = threading.Lock()
+
+    def evict(self) -> None:
+        if self.max_age:
+            oldest = time.time() - self.max_age
+            while self.entries and next(iter(self.entries.values()))[0] < oldest:
+                self.entries.popitem(last=False)
+                self.evicted_age += 1
+        if self.max_size:
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evicted_size += 1
+
+    def __setitem__(self, key, value) -> None:
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time(), value)
+            self.evict()
+
+    def __contains__(self, key) -> bool:
+        with self.lock:
+            self.evict()
+            return key in self.entries
+
+    def __delitem__(self, key) -> None:
+        with self.lock:
+            del self.entries[key]
+
+    def pop(self, key, default=None):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def __len__(self) -> int:
+        with self.lock:
+            self.evict()
+            return len(self.entries)
+
+    def values(self):
+        with self.lock:
+            self.evict()
+            return [value for _, value in self.entries.values()]
+
+    def page(self, offset: int, limit: int) -> list:
+        """The values from the offset-th oldest one, at most limit of them."""
+        with self.lock:
+            self.evict()
+            return [value for _, value in islice(self.entries.values(), offset, offset + limit)]
+
+    def stats(self) -> dict:
+        with self.lock:
+            self.evict()
+            return {"size": len(self.entries), "max_size": self.max_size, "max_age": self.max_age,
+                    "evicted_size": self.evicted_size, "evicted_age": self.evicted_age}
@@ -0,0 +1,76 @@
+import threading
+import time
+
+from dotenv import load_dotenv
+import os
+
+load_dotenv(os.path.join(os.path.dirname(__file__), '..', '.env'))
+CAPACITY = int(os.getenv("CAPACITY"))
+CAPACITY_MODE = os.getenv("CAPACITY_MODE", "fixed")  # fixed (always CAPACITY) or adaptive
+CAPACITY_MIN = int(os.getenv("CAPACITY_MIN", "1"))  # limits of the adaptive capacity
+CAPACITY_MAX = int(os.getenv("CAPACITY_MAX", "100"))
+CAPACITY_TARGET_INTERVAL = float(os.getenv("CAPACITY_TARGET_INTERVAL", "1.0"))  # seconds between blocks to aim for
+
+# a block should take at least this many times the time it takes to apply a block to fill up,
+# so that the lottery and the delivery of the blocks stay a small part of the work
+OVERHEAD_FACTOR = 10
+SMOOTHING = 0.2  # weight of the newest measurement in the moving averages
+
+
+def capacity_allowed(capacity: int) -> bool:
+    """The check of the validators: the capacity recorded in a block must be within the configured limits."""
+    if CAPACITY_MODE == "adaptive":
+        return CAPACITY_MIN <= capacity <= CAPACITY_MAX
+    return capacity == CAPACITY
+
+
+class CapacityController:
+    """
+    Chooses the capacity of the next block. In the fixed mode it is always CAPACITY. In the adaptive mode it is
+    the number of transactions expected to arrive during one block interval, where the interval is
+    CAPACITY_TARGET_INTERVAL or OVERHEAD_FACTOR times the average time to apply a block, whichever is longer.
+    The arrival rate and the apply time are exponential moving averages, and the result is kept within
+    CAPACITY_MIN and CAPACITY_MAX. The chosen capacity is recorded in the block (see capacity_allowed).
+    """
+
+    def __init__(self, mode=CAPACITY_MODE) -> None:
+        if mode not in ["fixed", "adaptive"]:
+            raise ValueError("Invalid capacity mode. It should be 'fixed' or 'adaptive'.")
+        self.mode = mode
+        self.lock = threading.Lock()
+        self.last_arrival = None
+        self.arrival_interval = None  # average seconds between two transactions
+        self.apply_time = 0.0  # average seconds to apply a block
+
+    def record_arrival(self) -> None:
+        now = time.monotonic()
+        with self.lock:
+            if self.last_arrival is not None:
+                interval = now - self.last_arrival
+                if self.arrival_interval is None:
+                    self.arrival_interval = interval
+                else:
+                    self.arrival_interval += SMOOTHING * (interval - self.arrival_interval)
+            self.last_arrival = now
+
+    def record_apply(self, seconds: float) -> None:
+        with self.lock:
+            self.apply_time += SMOOTHING * (seconds - self.apply_time)
+
+    def arrival_rate(self) -> float:
+        """Transactions per second. An idle period counts as a long interval, so the rate drops while idle."""
+        with self.lock:
+            if self.arrival_interval is None:
+                return 0.0
+            interval = max(self.arrival_interval, time.monotonic() - self.last_arrival)
+        return 1 / interval if interval > 0 else float(CAPACITY_MAX)
+
+    def capacity(self) -> int:
+        if self.mode == "fixed":
+            return CAPACITY
+        interval = max(CAPACITY_TARGET_INTERVAL, OVERHEAD_FACTOR * self.apply_time)
+        return max(CAPACITY_MIN, min(CAPACITY_MAX, round(self.arrival_rate() * interval)))
+
+    def stats(self) -> dict:
+        return {"mode": self.mode, "capacity": self.capacity(), "arrival_rate": self.arrival_rate(),
+                "apply_time": self.apply_time}
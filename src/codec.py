@@ -0,0 +1,218 @@
+"""
+Compact binary encoding of transactions and blocks.
+
+Integers are zigzag varints, strings are a varint length followed by UTF-8 bytes, and numbers keep their type
+(int or float) because the JSON of a transaction, and so its hash, depends on it. Hex strings (transaction ids,
+signatures, hashes) are sent as raw bytes, with a flag for the few values that are not hex (e.g. the 'empty'
+signature of the genesis transaction or the previous hash '1' of the genesis block).
+"""
+import struct
+
+from src.transaction import Transaction
+
+from dotenv import load_dotenv
+import os
+
+load_dotenv(os.path.join(os.path.dirname(__file__), '..', '.env'))
+WIRE_FORMAT = os.getenv("WIRE_FORMAT", "json")  # json or binary, for the transactions and blocks this node sends
+
+BINARY_CONTENT_TYPE = "application/x-blockchat"
+JSON_HEADERS = {'Content-Type': 'application/json'}
+BINARY_HEADERS = {'Content-Type': BINARY_CONTENT_TYPE}
+
+FORMAT_VERSION = 2  # 2: blocks record their capacity
+TYPES = ["coins", "message"]
+DOUBLE = struct.Struct("<d")
+# raised by the decoders on a truncated or malformed payload
+DECODE_ERRORS = (ValueError, IndexError, struct.error)
+
+
+class Writer:
+    def __init__(self) -> None:
+        self.buffer = bytearray()
+
+    def write_uint(self, value: int) -> None:
+        while value >= 0x80:
+            self.buffer.append((value & 0x7f) | 0x80)
+            value >>= 7
+        self.buffer.append(value)
+
+    def write_int(self, value: int) -> None:
+        self.write_uint(value * 2 if value >= 0 else -value * 2 - 1)
+
+    def write_bytes(self, value: bytes) -> None:
+        self.write_uint(len(value))
+        self.buffer += value
+
+    def write_str(self, value: str) -> None:
+        self.write_bytes(value.encode('utf-8'))
+
+    def write_number(self, value) -> None:
+        if isinstance(value, int):
+            self.buffer.append(0)
+            self.write_int(value)
+        else:
+            self.buffer.append(1)
+            self.buffer += DOUBLE.pack(value)
+
+    def write_hex(self, value: str) -> None:
+        try:
+            raw = bytes.fromhex(value)
+        except ValueError:
+            raw = None
+        if raw is not None and raw.hex() == value:
+            self.buffer.append(0)
+            self.write_bytes(raw)
+        else:
+            self.buffer.append(1)
+            self.write_str(value)
+
+
+class Reader:
+    def __init__(self, data: bytes) -> None:
+        self.data = memoryview(data)
+        self.pos = 0
+
+    def read_byte(self) -> int:
+        value = self.data[self.pos]
+        self.pos += 1
+        return value
+
+    def read_uint(self) -> int:
+        value = 0
+        shift = 0
+        while True:
+            byte = self.read_byte()
+            value |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return value
+            shift += 7
+
+    def read_int(self) -> int:
+        value = self.read_uint()
+        return value >> 1 if value & 1 == 0 else -(value >> 1) - 1
+
+    def read_bytes(self) -> bytes:
+        length = self.read_uint()
+        value = bytes(self.data[self.pos:self.pos + length])
+        if len(value) != length:
+            raise ValueError("Truncated data")
+        self.pos += length
+        return value
+
+    def read_str(self) -> str:
+        return self.read_bytes().decode('utf-8')
+
+    def read_number(self):
+        flag = self.read_byte()
+        if flag == 0:
+            return self.read_int()
+        if flag != 1:
+            raise ValueError(f"invalid number flag {flag}")
+        value = DOUBLE.unpack_from(self.data, self.pos)[0]
+        self.pos += DOUBLE.size
+        return value
+
+    def read_hex(self) -> str:
+        flag = self.read_byte()
+        if flag == 0:
+            return self.read_bytes().hex()
+        if flag != 1:
+            raise ValueError(f"invalid hex flag {flag}")
+        return self.read_str()
+
+
+def write_transaction(writer: Writer, transaction: Transaction) -> None:
+    writer.write_str(transaction.sender_address)
+    writer.write_str(transaction.receiver_address)
+    writer.buffer.append(TYPES.index(transaction.type_of_transaction))
+    writer.write_number(transaction.amount)
+    writer.write_str(transaction.message)
+    writer.write_int(transaction.nonce)
+    writer.write_hex(transaction.transaction_id)
+    writer.write_hex(transaction.signature)
+
+
+def read_transaction(reader: Reader) -> Transaction:
+    sender_address = reader.read_str()
+    receiver_address = reader.read_str()
+    type_of_transaction = TYPES[reader.read_byte()]
+    amount = reader.read_number()
+    message = reader.read_str()
+    nonce = reader.read_int()
+    transaction_id = reader.read_hex()
+    signature = reader.read_hex()
+    return Transaction(sender_address, receiver_address, type_of_transaction, amount, message, nonce,
+                       transaction_id, signature)
+
+
+def encode_transactions(transactions: list) -> bytes:
+    """Encode a list of transactions (a single transaction is a list of one)."""
+    writer = Writer()
+    writer.buffer.append(FORMAT_VERSION)
+    writer.write_uint(len(transactions))
+    for transaction in transactions:
+        write_transaction(writer, transaction)
+    return bytes(writer.buffer)
+
+
+def decode_transactions(data: bytes) -> list:
+    reader = Reader(data)
+    if reader.read_byte() != FORMAT_VERSION:
+        raise ValueError("Unsupported binary format version")
+    return [read_transaction(reader) for _ in range(reader.read_uint())]
+
+
+def encode_block(block) -> bytes:
+    writer = Writer()
+    writer.buffer.append(FORMAT_VERSION)
+    writer.write_int(block.index)
+    writer.write_number(block.timestamp)
+    writer.write_int(block.validator)
+    writer.write_uint(block.capacity)
+    writer.write_hex(block.previous_hash)
+    writer.write_hex(block.current_hash)
+    writer.write_uint(len(block.transactions))
+    for transaction in block.transactions:
+        write_transaction(writer, transaction)
+    return bytes(writer.buffer)
+
+
+def decode_block(data: bytes) -> tuple:
+    """
+    Decode a block in one pass. Returns the block fields as a dictionary (like the JSON of Block.serialize,
+    without the transactions) and the list of Transaction objects.
+    """
+    reader = Reader(data)
+    if reader.read_byte() != FORMAT_VERSION:
+        raise ValueError("Unsupported binary format version")
+    fields = {
+        "index": reader.read_int(),
+        "timestamp": reader.read_number(),
+        "validator": reader.read_int(),
+        "capacity": reader.read_uint(),
+        "previous_hash": reader.read_hex(),
+        "current_hash": reader.read_hex()
+    }
+    transactions = [read_transaction(reader) for _ in range(reader.read_uint())]
+    return fields, transactions
+
+
+def encode_blocks(height: int, blocks: list) -> bytes:
+    """Encode a range of blocks (see /api/blocks), with the height of the chain of the sender."""
+    writer = Writer()
+    writer.buffer.append(FORMAT_VERSION)
+    writer.write_uint(height)
+    writer.write_uint(len(blocks))
+    for block in blocks:
+        writer.write_bytes(encode_block(block))
+    return bytes(writer.buffer)
+
+
+def decode_blocks(data: bytes) -> tuple:
+    """Returns the height of the chain of the sender and the list of (fields, transactions) of the blocks."""
+    reader = Reader(data)
+    if reader.read_byte() != FORMAT_VERSION:
+        raise ValueError("Unsupported binary format version")
+    height = reader.read_uint()
+    return height, [decode_block(reader.read_bytes()) for _ in range(reader.read_uint())]
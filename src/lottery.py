@@ -0,0 +1,58 @@
+import random
+from bisect import bisect_right
+from collections import OrderedDict
+from itertools import accumulate
+
+
+class Lottery:
+    """
+    Stake-weighted selection of the validator of a block.
+
+    Each node gets int(100 * stake) tickets, in the order of the state, and the winning ticket is drawn with a
+    random.Random seeded with the hash of the previous block. Instead of building the list of tickets, the
+    cumulative ticket counts are kept and the winner is found with a binary search, which gives exactly the same
+    winners as the list. The cumulative counts are rebuilt only when the stakes change, and the winners are
+    memoized per (height, previous hash).
+    """
+
+    def __init__(self, max_cached=1024) -> None:
+        self.max_cached = max_cached
+        self.version = None  # the stakes version the cumulative counts were built from
+        self.ids = []
+        self.cumulative = []
+        self.winners = OrderedDict()  # {(height, previous_hash): winner}
+
+    def update(self, state: dict, version: int) -> None:
+        """Rebuild the cumulative ticket counts if the stakes have changed since the last draw."""
+        if version == self.version:
+            return
+        self.version = version
+        self.ids = [entry['id'] for entry in state.values()]
+        self.cumulative = list(accumulate(int(100 * entry["stake"]) for entry in state.values()))
+        self.winners.clear()
+
+    def draw(self, state: dict, version: int, height: int, previous_hash: str) -> int:
+        """
+        Select the validator of the block at the given height. version must change whenever the stakes
+        (or the nodes) of the state change, see StateJournal.stakes_version.
+        """
+        self.update(state, version)
+
+        key = (height, previous_hash)
+        winner = self.winners.get(key)
+        if winner is not None:
+            return winner
+
+        rng = random.Random(previous_hash)
+        total = self.cumulative[-1] if self.cumulative else 0
+        if total == 0:
+            # If there are no stakes, select a random node
+            winner = self.ids[rng.randint(0, len(self.ids) - 1)]
+        else:
+            # the ticket i belongs to the first node whose cumulative count is greater than i
+            winner = self.ids[bisect_right(self.cumulative, rng.randint(0, total - 1))]
+
+        self.winners[key] = winner
+        while len(self.winners) > self.max_cached:
+            self.winners.popitem(last=False)
+        return winner
@@ -0,0 +1,153 @@
+import heapq
+import threading
+import time
+from collections import OrderedDict
+from itertools import count
+
+from src.transaction import Transaction
+
+from dotenv import load_dotenv
+import os
+
+load_dotenv(os.path.join(os.path.dirname(__file__), '..', '.env'))
+MEMPOOL_MAX_SIZE = int(os.getenv("MEMPOOL_MAX_SIZE", "100000"))  # max pending transactions, 0 for no limit
+BLOCK_ASSEMBLY = os.getenv("BLOCK_ASSEMBLY", "fifo")  # fifo (arrival order) or fee (highest fees first)
+
+
+class Mempool:
+    """
+    The pending transactions (received, but not contained in a block yet).
+
+    The transactions are kept in an OrderedDict in arrival order, so taking the oldest N for a block and
+    removing a transaction by id (when it arrives in a block of another node) are O(1) per transaction.
+    The transactions of every sender are also indexed by nonce, with a heap of the nonces to find the
+    lowest pending nonce of a sender (removed nonces are dropped from the heap lazily).
+
+    Blocks are filled either in arrival order (take) or with the highest fees first (take_by_fee).
+
+    The writers hold the total_lock of the wallet, and change the mempool under self.lock too, so that readers
+    can get a consistent copy of the pending transactions (snapshot) without the total_lock.
+    """
+
+    def __init__(self, max_size=MEMPOOL_MAX_SIZE) -> None:
+        self.max_size = max_size
+        self.transactions = OrderedDict()  # {transaction_id: transaction}, in arrival order
+        self.by_sender = {}  # {sender_address: {nonce: transaction}}
+        self.nonce_heaps = {}  # {sender_address: heap of nonces}
+        # {transaction_id: (arrival time, arrival number)}, for the age of the oldest transaction
+        # and to break fee ties in arrival order
+        self.arrival = {}
+        self.counter = count()
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.transactions)
+
+    def __contains__(self, transaction_id: str) -> bool:
+        return transaction_id in self.transactions
+
+    def snapshot(self) -> list:
+        """The pending transactions, in arrival order."""
+        with self.lock:
+            return list(self.transactions.values())
+
+    def full(self) -> bool:
+        return bool(self.max_size) and len(self.transactions) >= self.max_size
+
+    def oldest_age(self) -> float:
+        """Seconds since the oldest pending transaction was added (0 if there is none)."""
+        with self.lock:
+            if not self.transactions:
+                return 0.0
+            return time.monotonic() - self.arrival[next(iter(self.transactions))][0]
+
+    def add(self, transaction: Transaction) -> bool:
+        """Add a pending transaction. Returns False if the mempool is full."""
+        if self.full():
+            return False
+        with self.lock:
+            self.transactions[transaction.transaction_id] = transaction
+            self.arrival[transaction.transaction_id] = (time.monotonic(), next(self.counter))
+            sender = transaction.sender_address
+            if sender not in self.by_sender:
+                self.by_sender[sender] = {}
+                self.nonce_heaps[sender] = []
+            self.by_sender[sender][transaction.nonce] = transaction
+            heapq.heappush(self.nonce_heaps[sender], transaction.nonce)
+        return True
+
+    def remove(self, transaction_id: str):
+        """Remove a transaction by id. Returns it, or None if it is not pending."""
+        with self.lock:
+            transaction = self.transactions.pop(transaction_id, None)
+            if transaction is not None:
+                self.unindex(transaction)
+        return transaction
+
+    def unindex(self, transaction: Transaction) -> None:
+        self.arrival.pop(transaction.transaction_id, None)
+        sender = transaction.sender_address
+        pending = self.by_sender[sender]
+        if pending.get(transaction.nonce) is transaction:
+            del pending[transaction.nonce]
+        if not pending:
+            del self.by_sender[sender]
+            del self.nonce_heaps[sender]
+
+    def take(self, n: int) -> list:
+        """Remove and return the n oldest transactions (or all of them, if there are fewer)."""
+        taken = []
+        with self.lock:
+            while self.transactions and len(taken) < n:
+                _, transaction = self.transactions.popitem(last=False)
+                self.unindex(transaction)
+                taken.append(transaction)
+        return taken
+
+    def head(self, sender_address: str):
+        """The pending transaction of the sender with the lowest nonce, or None."""
+        pending = self.by_sender.get(sender_address)
+        if not pending:
+            return None
+        heap = self.nonce_heaps[sender_address]
+        while heap[0] not in pending:
+            heapq.heappop(heap)
+        return pending[heap[0]]
+
+    def next_of(self, sender_address: str, nonce: int):
+        """The pending transaction of the sender with the lowest nonce after the given one, or None."""
+        pending = self.by_sender.get(sender_address)
+        if not pending:
+            return None
+        # the nonces of a sender are usually consecutive, the rest are only searched when there is a gap
+        transaction = pending.get(nonce + 1)
+        if transaction is None:
+            later = [other for other in pending if other > nonce]
+            transaction = pending[min(later)] if later else None
+        return transaction
+
+    def take_by_fee(self, n: int, fits) -> list:
+        """
+        Remove and return up to n transactions with the highest fees. The transactions of every sender are taken
+        in nonce order: a heap holds the next transaction of each sender, and when one is taken it is replaced by
+        the following transaction of the same sender. fits(transaction) decides if a transaction can follow the
+        ones already taken (e.g. if the sender still has the balance); if not, the rest of its sender's
+        transactions stay pending too.
+        """
+        heap = []
+        for sender in self.by_sender:
+            transaction = self.head(sender)
+            heap.append((-transaction.fee(), self.arrival[transaction.transaction_id], transaction))
+        heapq.heapify(heap)
+
+        taken = []
+        while heap and len(taken) < n:
+            _, _, transaction = heapq.heappop(heap)
+            if not fits(transaction):
+                continue
+            following = self.next_of(transaction.sender_address, transaction.nonce)
+            self.remove(transaction.transaction_id)
+            taken.append(transaction)
+            if following is not None:
+                heapq.heappush(heap, (-following.fee(), self.arrival[following.transaction_id], following))
+        return taken
@@ -0,0 +1,65 @@
+"""
+Merkle tree over the transactions of a block. The leaves are the SHA-256 digests of the serialized transactions
+(so they cover the transaction id, the fields and the signature). Leaves and interior nodes are hashed with
+different prefixes (0x00 and 0x01), so a node can not be passed off as a leaf. On a level with an odd number of
+nodes the last node is promoted to the next level as it is, instead of being paired with itself, so two different
+lists of transactions (e.g. [a, b, c] and [a, b, c, c]) can not have the same root.
+"""
+import hashlib
+
+LEAF_PREFIX = b"\x00"
+NODE_PREFIX = b"\x01"
+
+
+def leaf_hash(serialized_transaction: str) -> bytes:
+    return hashlib.sha256(LEAF_PREFIX + serialized_transaction.encode('utf-8')).digest()
+
+
+def parent_hash(left: bytes, right: bytes) -> bytes:
+    return hashlib.sha256(NODE_PREFIX + left + right).digest()
+
+
+def next_level(level: list) -> list:
+    parents = [parent_hash(level[i], level[i + 1]) for i in range(0, len(level) - 1, 2)]
+    if len(level) % 2 == 1:
+        parents.append(level[-1])
+    return parents
+
+
+def merkle_root(leaves: list) -> bytes:
+    if not leaves:
+        return hashlib.sha256(b"").digest()
+
+    level = leaves
+    while len(level) > 1:
+        level = next_level(level)
+    return level[0]
+
+
+def merkle_proof(leaves: list, position: int) -> list:
+    """
+    The inclusion proof of the leaf at the given position: the sibling hashes from the leaf up to the root,
+    as a list of {"hash": hex, "side": "left" or "right"} dictionaries (the side of the sibling).
+    A node promoted without a sibling adds no step.
+    """
+    proof = []
+    level = leaves
+    while len(level) > 1:
+        if position % 2 == 1:
+            proof.append({"hash": level[position - 1].hex(), "side": "left"})
+        elif position + 1 < len(level):
+            proof.append({"hash": level[position + 1].hex(), "side": "right"})
+        level = next_level(level)
+        position //= 2
+    return proof
+
+
+def verify_proof(serialized_transaction: str, proof: list, root: str) -> bool:
+    current = leaf_hash(serialized_transaction)
+    for step in proof:
+        sibling = bytes.fromhex(step["hash"])
+        if step["side"] == "left":
+            current = parent_hash(sibling, current)
+        else:
+            current = parent_hash(current, sibling)
+    return current.hex() == root
@@ -0,0 +1,304 @@
+import inspect
+import threading
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from functools import wraps
+
+from dotenv import load_dotenv
+import os
+
+load_dotenv(os.path.join(os.path.dirname(__file__), '..', '.env'))
+METRICS = int(os.getenv("METRICS", "1"))  # 0 to stop recording (the /metrics endpoint is then disabled)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# seconds, from well below a signature verification to the broadcast timeout
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                   5.0, 10.0)
+
+# every metric, in the order they are rendered
+REGISTRY = []
+
+
+def label_text(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def number_text(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class HistogramValues:
+    """The bucket counts, sum and count of one histogram for one set of label values."""
+
+    def __init__(self, buckets: tuple) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is the +Inf bucket
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        if not METRICS:
+            return
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+
+class Metric(ABC):
+    """A metric with optional labels, rendered in the Prometheus text format."""
+    type = None
+
+    def __init__(self, name: str, documentation: str, labelnames=()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        REGISTRY.append(self)
+
+    @abstractmethod
+    def samples(self) -> list:
+        """(suffix, label values, extra label text, value) of every sample."""
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for suffix, values, extra, value in self.samples():
+            labels = label_text(self.labelnames, values)
+            if extra:
+                labels = labels[:-1] + "," + extra + "}" if labels else "{" + extra + "}"
+            lines.append(f"{self.name}{suffix}{labels} {number_text(value)}")
+        return lines
+
+
+class RecordedMetric(Metric):
+    """
+    A metric whose values are recorded as things happen. The values of every set of label values are created
+    on first use and kept in self.children.
+    """
+
+    def __init__(self, name: str, documentation: str, labelnames=()) -> None:
+        self.children = {}  # {label values: values}
+        self.lock = threading.Lock()
+        super().__init__(name, documentation, labelnames)
+
+    @abstractmethod
+    def new_values(self):
+        """The values of a new set of label values."""
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self.new_values())
+        return child
+
+
+class Histogram(RecordedMetric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS) -> None:
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames)
+
+    def new_values(self) -> HistogramValues:
+        return HistogramValues(self.buckets)
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)
+
+    def samples(self) -> list:
+        samples = []
+        for values, child in list(self.children.items()):
+            with child.lock:
+                counts = list(child.counts)
+                total = child.sum
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                samples.append(("_bucket", values, f'le="{number_text(bound)}"', cumulative))
+            samples.append(("_sum", values, "", total))
+            samples.append(("_count", values, "", cumulative))
+        return samples
+
+
+class CounterValue:
+    def __init__(self) -> None:
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1) -> None:
+        if not METRICS:
+            return
+        with self.lock:
+            self.value += amount
+
+
+class Counter(RecordedMetric):
+    type = "counter"
+
+    def new_values(self) -> CounterValue:
+        return CounterValue()
+
+    def inc(self, amount=1) -> None:
+        self.labels().inc(amount)
+
+    def samples(self) -> list:
+        return [("", values, "", child.value) for values, child in list(self.children.items())]
+
+
+class Gauge(Metric):
+    """
+    A value of the node state that is read when the metrics are rendered, so it costs nothing in between.
+    The function returns a number, or a dictionary {label values: number} if the gauge has labels.
+    """
+
+    def __init__(self, name: str, documentation: str, function, labelnames=(), type="gauge") -> None:
+        self.function = function
+        self.type = type
+        super().__init__(name, documentation, labelnames)
+
+    def samples(self) -> list:
+        value = self.function()
+        if not self.labelnames:
+            return [("", (), "", value)]
+        return [("", values, "", number) for values, number in value.items()]
+
+
+def render() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def timed(histogram: Histogram):
+    """Decorator that observes the duration of every call of a function (or a coroutine function)."""
+    values = histogram.labels()
+
+    def decorator(function):
+        if inspect.iscoroutinefunction(function):
+            @wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await function(*args, **kwargs)
+                finally:
+                    values.observe(time.perf_counter() - start)
+            return async_wrapper
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                values.observe(time.perf_counter() - start)
+        return wrapper
+
+    return decorator
+
+
+RECEIVE_TRANSACTION_SECONDS = Histogram(
+    "blockchat_receive_transaction_seconds",
+    "Time to validate and process a received transaction, with the total_lock held.")
+RECEIVE_BLOCK_SECONDS = Histogram(
+    "blockchat_receive_block_seconds",
+    "Time to accept a block pushed by a peer or pulled during sync, signature checks and lock wait included.")
+BLOCK_APPLY_SECONDS = Histogram(
+    "blockchat_block_apply_seconds",
+    "Time to validate and commit a received block, with the total_lock held.")
+MINE_BLOCK_SECONDS = Histogram(
+    "blockchat_mine_block_seconds",
+    "Time of a mine_block call: the wait for the total_lock, sealing and committing the block and queueing it "
+    "for delivery.")
+BROADCAST_TRANSACTION_SECONDS = Histogram(
+    "blockchat_broadcast_transaction_seconds",
+    "Time to sign, broadcast and add an own transaction.")
+BROADCAST_BATCH_SECONDS = Histogram(
+    "blockchat_broadcast_batch_seconds",
+    "Time to send a batch of transactions to the peers.")
+BROADCAST_BLOCK_SECONDS = Histogram(
+    "blockchat_broadcast_block_seconds",
+    "Time to deliver a block to a peer, retries included.", ["peer"])
+LOCK_WAIT_SECONDS = Histogram(
+    "blockchat_lock_wait_seconds",
+    "Time spent waiting to acquire a lock.", ["lock"])
+LOCK_HOLD_SECONDS = Histogram(
+    "blockchat_lock_hold_seconds",
+    "Time a lock was held.", ["lock"])
+PEER_REQUEST_SECONDS = Histogram(
+    "blockchat_peer_request_seconds",
+    "Latency of the requests to a peer.", ["peer", "path"])
+PEER_ERRORS = Counter(
+    "blockchat_peer_errors_total",
+    "Failed requests to a peer (unreachable or an error status).", ["peer", "path", "reason"])
+
+
+def observe_peer_request(node: str, path: str, seconds: float, status) -> None:
+    """Record a request to a peer, status is None if the peer could not be reached."""
+    PEER_REQUEST_SECONDS.labels(node, path).observe(seconds)
+    if status is None:
+        PEER_ERRORS.labels(node, path, "unreachable").inc()
+    elif status != 200:
+        PEER_ERRORS.labels(node, path, str(status)).inc()
+
+
+class InstrumentedLock:
+    """A threading.Lock that records how long its users wait for it and hold it."""
+
+    def __init__(self, name: str) -> None:
+        self.lock = threading.Lock()
+        self.wait = LOCK_WAIT_SECONDS.labels(name)
+        self.hold = LOCK_HOLD_SECONDS.labels(name)
+        self.acquired_at = None  # only read and written by the holder
+
+    def acquire(self, blocking=True, timeout=-1) -> bool:
+        start = time.perf_counter()
+        acquired = self.lock.acquire(blocking, timeout)
+        if acquired:
+            self.acquired_at = time.perf_counter()
+            self.wait.observe(self.acquired_at - start)
+        return acquired
+
+    def release(self) -> None:
+        held = time.perf_counter() - self.acquired_at
+        self.lock.release()
+        self.hold.observe(held)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.release()
+
+
+def new_lock(name: str):
+    """The lock of the given name, instrumented if the metrics are enabled."""
+    return InstrumentedLock(name) if METRICS else threading.Lock()
+
+
+def watch_wallet(wallet) -> None:
+    """The gauges of the node state, read from the wallet when the metrics are rendered."""
+    Gauge("blockchat_mempool_size", "Pending transactions.", lambda: len(wallet.mempool))
+    Gauge("blockchat_chain_height", "Blocks in the chain.", lambda: len(wallet.blockchain.chain))
+    Gauge("blockchat_pending_blocks", "Blocks received out of order, waiting for the previous ones.",
+          lambda: len(wallet.pending_blocks))
+    Gauge("blockchat_block_capacity", "Capacity of the next block this node seals.",
+          lambda: wallet.block_capacity.capacity())
+    Gauge("blockchat_transactions_sent_total", "Own transactions.", lambda: wallet.nonce, type="counter")
+    Gauge("blockchat_transactions_received_total", "Transactions received from peers.",
+          lambda: wallet.received_transactions_count, type="counter")
+    Gauge("blockchat_transactions_accepted_total", "Transactions committed in the blocks sealed by this node.",
+          lambda: wallet.accepted_transactions_count, type="counter")
+    Gauge("blockchat_block_delivery_queued", "Blocks waiting to be delivered to a peer.",
+          lambda: {(node, ): status["queued"] for node, status in wallet.block_delivery.get_status().items()},
+          ["peer"])
@@ -0,0 +1,288 @@
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from src.codec import WIRE_FORMAT, BINARY_HEADERS, JSON_HEADERS, encode_transactions
+from src.metrics import BROADCAST_BATCH_SECONDS, BROADCAST_BLOCK_SECONDS, observe_peer_request, timed
+
+from dotenv import load_dotenv
+import os
+
+load_dotenv(os.path.join(os.path.dirname(__file__), '..', '.env'))
+BROADCAST_PARALLEL = int(os.getenv("BROADCAST_PARALLEL", "1"))  # 0 for the old sequential broadcast
+BROADCAST_POLICY = os.getenv("BROADCAST_POLICY", "all")  # all, quorum or any
+BROADCAST_TIMEOUT = float(os.getenv("BROADCAST_TIMEOUT", "10"))  # seconds, per request
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "16"))
+BLOCK_DELIVERY_RETRIES = int(os.getenv("BLOCK_DELIVERY_RETRIES", "3"))  # failed attempts before a block is reported
+BLOCK_DELIVERY_MAX_BACKOFF = float(os.getenv("BLOCK_DELIVERY_MAX_BACKOFF", "5"))  # seconds between the later attempts
+GOSSIP_BATCH = int(os.getenv("GOSSIP_BATCH", "1"))  # 0 to send every transaction on its own
+GOSSIP_BATCH_SIZE = int(os.getenv("GOSSIP_BATCH_SIZE", "64"))  # max transactions per batch
+GOSSIP_BATCH_WINDOW = float(os.getenv("GOSSIP_BATCH_WINDOW", "0.005"))  # seconds to wait for more transactions
+
+
+def policy_satisfied(policy: str, ok: int, total: int) -> bool:
+    """Check if ok successful deliveries out of total satisfy a partial failure policy (all, quorum or any)."""
+    if total == 0:
+        return True
+    if policy == "any":
+        return ok > 0
+    if policy == "quorum":
+        return ok > total // 2
+    return ok == total
+
+
+def broadcast_succeeded(policy: str, nodes: list, results: dict) -> bool:
+    """Decide, according to the partial failure policy, if a broadcast with the given {node: response} results
+    was successful. The errors returned by the peers are printed."""
+    if not nodes:
+        return True
+
+    ok = 0
+    for node in nodes:
+        response = results.get(node)
+        if response is not None and response.status_code == 200:
+            ok += 1
+        elif response is not None:
+            try:
+                print(f"Error from {node}:", response.json())
+            except ValueError:
+                print(f"Error from {node}:", response.status_code)
+
+    return policy_satisfied(policy, ok, len(nodes))
+
+
+def batch_accepted(policy: str, nodes: list, results: dict, size: int) -> list:
+    """
+    For a batch of size transactions sent to /api/receive_transactions, decide for every transaction
+    if enough peers accepted it (according to the partial failure policy).
+    """
+    # per peer, the list of per-transaction results of the batch
+    accepted = {}
+    for node in nodes:
+        response = results.get(node)
+        if response is None or response.status_code != 200:
+            accepted[node] = [False] * size
+            continue
+        accepted[node] = [result["status"] == 200 for result in response.json()["results"]]
+
+    return [policy_satisfied(policy, sum(1 for node in nodes if accepted[node][i]), len(nodes)) for i in range(size)]
+
+
+def batch_payload(transactions: list) -> tuple:
+    """The payload and headers of a batch of transactions for /api/receive_transactions."""
+    if WIRE_FORMAT == "binary":
+        return encode_transactions(transactions), BINARY_HEADERS
+    return json.dumps({"transactions": [transaction.serialize() for transaction in transactions]}), JSON_HEADERS
+
+
+class PeerPool:
+    """
+    Keeps one persistent HTTP session (keep-alive connection pool) per peer, so that repeated requests
+    to the same node reuse the TCP connection, and sends a payload to many peers at once.
+    """
+
+    def __init__(self, parallel=BROADCAST_PARALLEL, policy=BROADCAST_POLICY, timeout=BROADCAST_TIMEOUT,
+                 max_workers=BROADCAST_WORKERS) -> None:
+        if policy not in ["all", "quorum", "any"]:
+            raise ValueError("Invalid broadcast policy. It should be 'all', 'quorum' or 'any'.")
+
+        self.parallel = parallel
+        self.policy = policy
+        self.timeout = timeout
+        self.sessions = {}  # {address: requests.Session}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="broadcast")
+
+    def session(self, node: str) -> requests.Session:
+        with self.lock:
+            session = self.sessions.get(node)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=BROADCAST_WORKERS)
+                session.mount("http://", adapter)
+                self.sessions[node] = session
+            return session
+
+    def post(self, node: str, path: str, payload, headers=None):
+        """
+        POST the payload to a single peer. Returns the response, or None if the peer could not be reached
+        (connection error or timeout).
+        """
+        if headers is None:
+            headers = JSON_HEADERS
+        start = time.perf_counter()
+        try:
+            response = self.session(node).post(f"http://{node}{path}", data=payload, headers=headers,
+                                               timeout=self.timeout)
+        except requests.exceptions.RequestException as e:
+            print(f"Error: could not reach {node}: {e}")
+            response = None
+        observe_peer_request(node, path, time.perf_counter() - start,
+                             None if response is None else response.status_code)
+        return response
+
+    def get(self, node: str, path: str, params=None, headers=None):
+        """GET from a single peer. Returns the response, or None if the peer could not be reached."""
+        start = time.perf_counter()
+        try:
+            response = self.session(node).get(f"http://{node}{path}", params=params, headers=headers,
+                                              timeout=self.timeout)
+        except requests.exceptions.RequestException as e:
+            print(f"Error: could not reach {node}: {e}")
+            response = None
+        observe_peer_request(node, path, time.perf_counter() - start,
+                             None if response is None else response.status_code)
+        return response
+
+    def broadcast(self, nodes: list, path: str, payload, headers=None) -> dict:
+        """
+        Send the payload to every node and return a dictionary {node: response or None}.
+        In sequential mode the broadcast stops at the first failed peer, like before.
+        """
+        results = {}
+        if not self.parallel:
+            for node in nodes:
+                response = self.post(node, path, payload, headers)
+                results[node] = response
+                if response is None or response.status_code != 200:
+                    break
+            return results
+
+        futures = {node: self.executor.submit(self.post, node, path, payload, headers) for node in nodes}
+        for node, future in futures.items():
+            results[node] = future.result()
+        return results
+
+    def succeeded(self, nodes: list, results: dict) -> bool:
+        """Decide, according to the partial failure policy, if a broadcast to the given nodes was successful."""
+        return broadcast_succeeded(self.policy, nodes, results)
+
+
+class BlockDelivery:
+    """
+    Delivers blocks to the peers in the background. Every peer has its own queue and worker thread, so blocks
+    reach each peer in the order they were mined and a slow peer does not hold back the others.
+    A block is retried, with a backoff of up to max_backoff seconds, until the peer has it (a peer that is down
+    would otherwise stay behind for good), and only dropped if the peer rejects it.
+    """
+
+    def __init__(self, peers: PeerPool, retries=BLOCK_DELIVERY_RETRIES, max_backoff=BLOCK_DELIVERY_MAX_BACKOFF) -> None:
+        self.peers = peers
+        self.retries = retries
+        self.max_backoff = max_backoff
+        self.queues = {}  # {address: queue.Queue of (index, payload, headers)}
+        self.status = {}  # {address: {"delivered", "queued", "failures", "last_error"}}
+        self.lock = threading.Lock()
+
+    def submit(self, nodes: list, index: int, payload, headers=None) -> None:
+        with self.lock:
+            for node in nodes:
+                if node not in self.queues:
+                    self.queues[node] = queue.Queue()
+                    self.status[node] = {"delivered": None, "queued": 0, "failures": 0, "last_error": None}
+                    threading.Thread(target=self.worker, args=(node,), daemon=True).start()
+                self.status[node]["queued"] += 1
+                self.queues[node].put((index, payload, headers))
+
+    def worker(self, node: str) -> None:
+        while True:
+            index, payload, headers = self.queues[node].get()
+            start = time.perf_counter()
+            attempt = 0
+            while True:
+                response = self.peers.post(node, "/api/receive_block", payload, headers)
+                if response is not None and response.status_code == 200:
+                    error = None
+                    break
+                error = "unreachable" if response is None else f"status {response.status_code}"
+                if response is not None and response.status_code < 500:
+                    break  # the peer rejected the block, retrying will not help
+                attempt += 1
+                if attempt == max(self.retries, 1):
+                    self.failed(node, index, error + ", still retrying")
+                time.sleep(min(0.1 * (2 ** attempt), self.max_backoff))
+
+            BROADCAST_BLOCK_SECONDS.labels(node).observe(time.perf_counter() - start)
+
+            with self.lock:
+                status = self.status[node]
+                status["queued"] -= 1
+                if error is None:
+                    status["delivered"] = index
+            if error is not None:
+                self.failed(node, index, error)
+
+    def failed(self, node: str, index: int, error: str) -> None:
+        with self.lock:
+            status = self.status[node]
+            status["failures"] += 1
+            status["last_error"] = f"block {index}: {error}"
+        print(f"Error: block {index} could not be delivered to {node} ({error}).")
+
+    def get_status(self) -> dict:
+        with self.lock:
+            return {node: dict(status) for node, status in self.status.items()}
+
+
+class TransactionBatcher:
+    """
+    Coalesces outgoing transactions into batches for /api/receive_transactions. A batch is sent as soon as the
+    previous one has been delivered, so under load the transactions that arrive in the meantime are sent together,
+    while at low load a transaction does not wait more than the configured window.
+    """
+
+    def __init__(self, peers: PeerPool, max_size=GOSSIP_BATCH_SIZE, window=GOSSIP_BATCH_WINDOW) -> None:
+        self.peers = peers
+        self.max_size = max_size
+        self.window = window
+        self.queue = queue.Queue()  # of (nodes, serialized transaction, Future)
+        threading.Thread(target=self.flusher, daemon=True).start()
+
+    def submit(self, nodes: list, transaction) -> Future:
+        """Queue a signed transaction. The returned future resolves to True if the broadcast succeeded."""
+        future = Future()
+        self.queue.put((nodes, transaction, future))
+        return future
+
+    def collect(self) -> list:
+        batch = [self.queue.get()]
+        deadline = time.time() + self.window
+        while len(batch) < self.max_size:
+            try:
+                remaining = deadline - time.time()
+                if remaining > 0:
+                    batch.append(self.queue.get(timeout=remaining))
+                else:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def flusher(self) -> None:
+        while True:
+            batch = self.collect()
+            # transactions are normally sent to the same peers, but group them by peer list to be safe
+            groups = {}
+            for nodes, transaction, future in batch:
+                groups.setdefault(tuple(nodes), []).append((transaction, future))
+            for nodes, items in groups.items():
+                try:
+                    self.send(list(nodes), items)
+                except Exception as e:
+                    print("Error: batch broadcast failed:", e)
+                    for _, future in items:
+                        if not future.done():
+                            future.set_result(False)
+
+    @timed(BROADCAST_BATCH_SECONDS)
+    def send(self, nodes: list, items: list) -> None:
+        payload, headers = batch_payload([transaction for transaction, _ in items])
+        results = self.peers.broadcast(nodes, "/api/receive_transactions", payload, headers)
+
+        for (_, future), ok in zip(items, batch_accepted(self.peers.policy, nodes, results, len(items))):
+            future.set_result(ok)
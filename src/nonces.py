@@ -0,0 +1,74 @@
+from dotenv import load_dotenv
+import os
+
+load_dotenv(os.path.join(os.path.dirname(__file__), '..', '.env'))
+NONCE_WINDOW = int(os.getenv("NONCE_WINDOW", "1024"))  # out-of-order nonces remembered per sender
+
+
+class NonceWindow:
+    """
+    The nonces used by one sender, in constant memory: every nonce up to the high-water mark has been used,
+    and the used nonces above it (received out of order) are kept in a set. When the next nonce after the mark
+    is used, the mark moves up over the consecutive nonces of the set. Nonces more than the window above the mark
+    are refused, so the set stays bounded and a far-ahead nonce cannot move the mark over unused ones.
+    """
+
+    def __init__(self, high=0, above=()) -> None:
+        self.high = high
+        self.above = set(above)
+
+    def __contains__(self, nonce: int) -> bool:
+        return nonce <= self.high or nonce in self.above
+
+    def ahead(self, nonce: int, window: int) -> bool:
+        return nonce > self.high + window
+
+    def add(self, nonce: int, window: int) -> bool:
+        """Record a used nonce. Returns False, without recording it, if the nonce is too far ahead."""
+        if nonce in self:
+            return True
+        if self.ahead(nonce, window):
+            return False
+        self.above.add(nonce)
+        while self.high + 1 in self.above:
+            self.high += 1
+            self.above.remove(self.high)
+        return True
+
+
+class NonceTracker:
+    """
+    Replay protection: the nonces used by every sender, as a high-water mark and a window of NONCE_WINDOW
+    nonces above it. A nonce is rejected if it was used before (or is at or below the high-water mark), or if it is
+    more than NONCE_WINDOW above the high-water mark of the sender.
+    """
+
+    def __init__(self, window=NONCE_WINDOW) -> None:
+        self.window = window
+        self.senders = {}  # {address: NonceWindow}
+
+    def reset(self, nodes) -> None:
+        """Forget all nonces and track the given nodes."""
+        self.senders = {node: NonceWindow() for node in nodes}
+
+    def used(self, sender_address: str, nonce: int) -> bool:
+        nonces = self.senders.get(sender_address)
+        return nonces is not None and nonce in nonces
+
+    def ahead(self, sender_address: str, nonce: int) -> bool:
+        """True if the nonce is too far above the high-water mark of the sender to be tracked."""
+        nonces = self.senders.get(sender_address)
+        return nonces.ahead(nonce, self.window) if nonces is not None else nonce > self.window
+
+    def add(self, sender_address: str, nonce: int) -> bool:
+        nonces = self.senders.get(sender_address)
+        if nonces is None:
+            nonces = self.senders[sender_address] = NonceWindow()
+        return nonces.add(nonce, self.window)
+
+    def to_dict(self) -> dict:
+        """{address: [high-water mark, sorted nonces above it]}, for the snapshots."""
+        return {node: [nonces.high, sorted(nonces.above)] for node, nonces in self.senders.items()}
+
+    def load(self, data: dict) -> None:
+        self.senders = {node: NonceWindow(high, above) for node, (high, above) in data.items()}
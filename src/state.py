@@ -0,0 +1,155 @@
+import threading
+from collections import OrderedDict
+from copy import deepcopy
+
+from src.transaction import Transaction
+
+
+class StateJournal:
+    """
+    The state of all the nodes ({address: {public_key, id, balance, stake}}) kept as:
+    - hard: the committed state, with the effects of the transactions that are contained in blocks
+    - soft: the hard state plus the effects of the pending transactions, updated incrementally
+    - journal: the deltas of every pending transaction, in arrival order
+
+    When a block is accepted only the deltas of its transactions are applied to the hard state,
+    so the cost depends on the size of the block and not on the size of the state or of the pending list.
+
+    The writers (which also hold the total_lock of the wallet) change the states under self.lock, so readers
+    get a consistent copy with snapshot() without waiting for the total_lock. The copies are versioned:
+    as long as the state does not change, every reader gets the same copy.
+    """
+
+    def __init__(self) -> None:
+        self.hard = {}
+        self.soft = {}
+        self.journal = OrderedDict()  # {transaction_id: deltas}
+        # increased whenever the nodes or the stakes of the soft state change (used to cache the lottery)
+        self.stakes_version = 0
+        self.lock = threading.Lock()
+        self.version = 0  # increased on every change
+        self.snapshots = {}  # {"soft" or "hard": (version, copy)}
+
+    def reset(self, state: dict) -> None:
+        """Replace the whole state (e.g. with the state received from the bootstrap). Nothing is pending."""
+        with self.lock:
+            self.hard = deepcopy(state)
+            self.soft = deepcopy(state)
+            self.journal.clear()
+            self.stakes_version += 1
+            self.version += 1
+
+    def register(self, address: str, entry: dict) -> None:
+        with self.lock:
+            self.hard[address] = dict(entry)
+            self.soft[address] = dict(entry)
+            self.stakes_version += 1
+            self.version += 1
+
+    def snapshot(self, hard=False) -> dict:
+        """A consistent copy of the soft (or hard) state, which must not be changed by the caller."""
+        name = "hard" if hard else "soft"
+        cached = self.snapshots.get(name)
+        if cached is not None and cached[0] == self.version:
+            return cached[1]
+        with self.lock:
+            state = self.hard if hard else self.soft
+            copy = {address: dict(entry) for address, entry in state.items()}
+            self.snapshots[name] = (self.version, copy)
+        return copy
+
+    @staticmethod
+    def deltas(transaction: Transaction) -> list:
+        """
+        The changes a transaction makes to the state, as a list of (address, field, value, is_set) tuples.
+        Balances are changed by adding the value, stakes are set to it.
+        """
+        # Case: Stake
+        if transaction.receiver_address == "0":
+            return [(transaction.sender_address, "stake", transaction.amount, True)]
+
+        # Case: Coins
+        if transaction.type_of_transaction == "coins":
+            deltas = []
+            if transaction.sender_address != "0":
+                deltas.append((transaction.sender_address, "balance", -transaction.amount, False))
+                # 3% fee for the sender (the initial 1000 BCC transactions don't have a fee)
+                deltas.append((transaction.sender_address, "balance", -transaction.fee(), False))
+            deltas.append((transaction.receiver_address, "balance", transaction.amount, False))
+            return deltas
+
+        # Case: Message
+        return [(transaction.sender_address, "balance", -transaction.fee(), False)]
+
+    @staticmethod
+    def apply(state: dict, deltas: list) -> None:
+        for address, field, value, is_set in deltas:
+            if is_set:
+                state[address][field] = value
+            else:
+                state[address][field] += value
+
+    def apply_soft(self, deltas: list) -> None:
+        self.apply(self.soft, deltas)
+        if any(is_set for _, _, _, is_set in deltas):
+            self.stakes_version += 1
+
+    def add_pending(self, transaction: Transaction) -> None:
+        """Apply a pending transaction to the soft state and remember its deltas."""
+        deltas = self.deltas(transaction)
+        with self.lock:
+            self.apply_soft(deltas)
+            self.journal[transaction.transaction_id] = deltas
+            self.version += 1
+
+    def commit(self, transaction: Transaction) -> None:
+        """
+        Apply a transaction of an accepted block to the hard state. If it was pending, the soft state already
+        contains its effects, otherwise (it has not been received on its own yet) they are applied to it too.
+        """
+        with self.lock:
+            deltas = self.journal.pop(transaction.transaction_id, None)
+            if deltas is None:
+                deltas = self.deltas(transaction)
+                self.apply_soft(deltas)
+            self.apply(self.hard, deltas)
+            self.version += 1
+
+    def credit(self, address: str, amount: float) -> None:
+        """Give coins (e.g. the reward of a block) in both states."""
+        with self.lock:
+            self.hard[address]["balance"] += amount
+            self.soft[address]["balance"] += amount
+            self.version += 1
+
+    def overlay(self) -> "StateOverlay":
+        return StateOverlay(self.hard)
+
+
+class StateOverlay:
+    """
+    A copy-on-write view of a state, used to check the transactions of a block one after the other
+    without changing the real state. Only the entries of the nodes that are touched are copied,
+    so discarding it (e.g. when the block is invalid) costs nothing.
+    """
+
+    def __init__(self, base: dict) -> None:
+        self.base = base
+        self.changed = {}
+
+    def __getitem__(self, address: str) -> dict:
+        entry = self.changed.get(address)
+        if entry is None:
+            entry = dict(self.base[address])
+            self.changed[address] = entry
+        return entry
+
+    def __contains__(self, address: str) -> bool:
+        return address in self.base
+
+    def apply(self, transaction: Transaction) -> None:
+        for address, field, value, is_set in StateJournal.deltas(transaction):
+            if is_set:
+                self[address][field] = value
+            else:
+                self[address][field] += value
@@ -0,0 +1,110 @@
+from src.codec import WIRE_FORMAT, BINARY_CONTENT_TYPE, decode_blocks
+from src.network import PeerPool
+from src.transaction import deserialize_trans
+
+from dotenv import load_dotenv
+import os
+
+load_dotenv(os.path.join(os.path.dirname(__file__), '..', '.env'))
+SYNC_CHUNK_SIZE = int(os.getenv("SYNC_CHUNK_SIZE", "100"))  # blocks per /api/blocks request
+SYNC_PARALLEL = int(os.getenv("SYNC_PARALLEL", "4"))  # chunks requested at the same time
+
+
+class ChainSync:
+    """
+    Pulls the blocks a node is missing from its peers, in chunks of /api/blocks?from=H&limit=K.
+    The chunks are requested from the peers that have them, several at a time and spread over the peers,
+    and they are handed to the node in order of height.
+    """
+
+    def __init__(self, peers: PeerPool, chunk_size=SYNC_CHUNK_SIZE, parallel=SYNC_PARALLEL) -> None:
+        self.peers = peers
+        self.chunk_size = chunk_size
+        self.parallel = max(1, parallel)
+        self.headers = {'Accept': BINARY_CONTENT_TYPE if WIRE_FORMAT == "binary" else 'application/json'}
+
+    def fetch(self, node: str, start: int, limit: int):
+        """
+        Request the blocks [start, start + limit) from a peer. Returns the height of its chain and the list of
+        (fields, transactions) of the blocks, or None if the peer could not answer.
+        """
+        response = self.peers.get(node, "/api/blocks", {"from": start, "limit": limit}, self.headers)
+        if response is None or response.status_code != 200:
+            return None
+
+        if response.headers.get('Content-Type', '').startswith(BINARY_CONTENT_TYPE):
+            return decode_blocks(response.content)
+
+        data = response.json()
+        blocks = []
+        for block in data["blocks"]:
+            transactions = [deserialize_trans(transaction) for transaction in block["transactions"]]
+            blocks.append((block, transactions))
+        return data["height"], blocks
+
+    def heights(self, nodes: list) -> dict:
+        """The chain height of every reachable peer."""
+        futures = {node: self.peers.executor.submit(self.fetch, node, 0, 0) for node in nodes}
+        heights = {}
+        for node, future in futures.items():
+            result = future.result()
+            if result is not None:
+                heights[node] = result[0]
+        return heights
+
+    def fetch_chunk(self, candidates: list, start: int, limit: int):
+        """Request a chunk from the first candidate peer that returns all of its blocks."""
+        for node in candidates:
+            result = self.fetch(node, start, limit)
+            if result is not None and len(result[1]) == limit:
+                return result[1]
+        return None
+
+    def request(self, heights: dict, begin: int, limit: int, number: int):
+        """Request a chunk in the background from the peers that have all of it, starting from a different one."""
+        candidates = [node for node in heights if heights[node] >= begin + limit]
+        shift = number % len(candidates)
+        candidates = candidates[shift:] + candidates[:shift]
+        return self.peers.executor.submit(self.fetch_chunk, candidates, begin, limit)
+
+    def sync(self, nodes: list, height, accept) -> int:
+        """
+        Bring the chain up to the height of the longest peer chain. height() returns the current length of the
+        local chain and accept(fields, transactions) adds a block, returning its status code like /api/receive_block.
+        Returns the number of blocks accepted.
+        """
+        accepted = 0
+        while True:
+            start = height()
+            heights = self.heights(nodes)
+            target = max(heights.values(), default=0)
+            if target <= start:
+                return accepted
+
+            chunks = [(begin, min(self.chunk_size, target - begin)) for begin in range(start, target, self.chunk_size)]
+            futures = []
+            progress = 0
+            for number, (begin, limit) in enumerate(chunks):
+                # keep up to `parallel` chunks in flight, requested ahead of the one being added
+                while len(futures) < min(number + self.parallel, len(chunks)):
+                    futures.append(self.request(heights, *chunks[len(futures)], len(futures)))
+
+                blocks = futures[number].result()
+                if blocks is None:
+                    print(f"Could not get the blocks from {begin} from any peer.")
+                    break
+                failed = False
+                for fields, transactions in blocks:
+                    if accept(fields, transactions) != 200:
+                        print(f"Synced block {fields['index']} was rejected.")
+                        failed = True
+                        break
+                    progress += 1
+                if failed:
+                    break
+
+            for future in futures:
+                future.cancel()
+            accepted += progress
+            if progress == 0:
+                return accepted
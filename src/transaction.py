@@ -4,8 +4,16 @@ from Crypto.Signature import PKCS1_v1_5
 from Crypto.Hash import SHA256
 from Crypto.PublicKey import RSA
 
+# fields that are signed (part of the hash), and fields that are serialized
+SIGNED_FIELDS = {"sender_address", "receiver_address", "type_of_transaction", "amount", "message", "nonce"}
+SERIALIZED_FIELDS = SIGNED_FIELDS | {"transaction_id", "signature"}
+
 
 class Transaction:
+    """
+    The canonical JSON, the hash and the serialized form of a transaction are computed once and cached.
+    Setting one of the fields drops the cached values that depend on it.
+    """
 
     def __init__(self, sender_address: str, receiver_address: str, type_of_transaction: str, amount: float,
                  message: str, nonce: int, transaction_id: str = None, signature: str = None) -> None:
@@ -29,7 +37,19 @@ class Transaction:
 
         return
 
+    def __setattr__(self, name, value) -> None:
+        super().__setattr__(name, value)
+        if name in SERIALIZED_FIELDS:
+            self.__dict__.pop("_serialized", None)
+            if name in SIGNED_FIELDS:
+                self.__dict__.pop("_stringified", None)
+                self.__dict__.pop("_hash", None)
+
     def stringify(self) -> str:
+        cached = self.__dict__.get("_stringified")
+        if cached is not None:
+            return cached
+
         transaction = {
             "sender_address": self.sender_address,
             "receiver_address": self.receiver_address,
@@ -39,13 +59,18 @@ class Transaction:
             "nonce": self.nonce
         }
 
-        return json.dumps(transaction)
+        self.__dict__["_stringified"] = json.dumps(transaction)
+        return self.__dict__["_stringified"]
 
     def hash_transaction(self) -> SHA256Hash:
-        serialized_transaction = self.stringify().encode('utf-8')
-        sha256_hash_object = SHA256.new(serialized_transaction)
+        cached = self.__dict__.get("_hash")
+        if cached is None:
+            serialized_transaction = self.stringify().encode('utf-8')
+            cached = SHA256.new(serialized_transaction)
+            self.__dict__["_hash"] = cached
 
-        return sha256_hash_object
+        # a copy, so that the cached hash object cannot be updated by the caller
+        return cached.copy()
 
     def sign_transaction(self, private_key: str) -> None:
         hash_obj = self.hash_transaction()
@@ -57,10 +82,27 @@ class Transaction:
         return
 
     def verify_signature(self, public_key: str) -> bool:
+        return self.verify_signature_with(make_verifier(public_key))
+
+    def verify_signature_with(self, verifier) -> bool:
+        """Verify the signature with an already constructed verifier (see make_verifier)."""
         hash_obj = self.hash_transaction()
-        public_key_obj = RSA.import_key(public_key)
-        verifier = PKCS1_v1_5.new(public_key_obj)
-        return verifier.verify(hash_obj, bytes.fromhex(self.signature))
+        try:
+            return verifier.verify(hash_obj, bytes.fromhex(self.signature))
+        except ValueError:
+            # the signature is not valid hex
+            return False
+
+    def fee(self) -> float:
+        """
+        The fee paid by the sender, which goes to the validator of the block: 3% of the amount for coins (except
+        the initial coins given by the bootstrap) and one coin per character for messages. Stakes are free.
+        """
+        if self.sender_address == "0" or self.receiver_address == "0":
+            return 0
+        if self.type_of_transaction == "coins":
+            return round(self.amount * 0.03, 3) if self.message != "Initial Transaction" else 0
+        return len(self.message)
 
     def verify_balance(self, sender_balance: int, stake: int) -> bool:
         paid_amount = 1.03 * self.amount if self.type_of_transaction == "coins" else len(self.message)
@@ -71,6 +113,10 @@ class Transaction:
             return False
 
     def serialize(self) -> str:
+        cached = self.__dict__.get("_serialized")
+        if cached is not None:
+            return cached
+
         transaction = {
             "sender_address": self.sender_address,
             "receiver_address": self.receiver_address,
@@ -82,7 +128,13 @@ class Transaction:
             "signature": self.signature
         }
 
-        return json.dumps(transaction)
+        self.__dict__["_serialized"] = json.dumps(transaction)
+        return self.__dict__["_serialized"]
+
+
+def make_verifier(public_key: str):
+    """Parse a PEM public key and build the PKCS#1 v1.5 verifier for it."""
+    return PKCS1_v1_5.new(RSA.import_key(public_key))
 
 
 def deserialize_trans(data: str) -> Transaction:
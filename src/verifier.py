@@ -0,0 +1,119 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from Crypto.Hash import SHA256
+
+from src.transaction import make_verifier
+
+from dotenv import load_dotenv
+import os
+
+load_dotenv(os.path.join(os.path.dirname(__file__), '..', '.env'))
+VERIFY_WORKERS = int(os.getenv("VERIFY_WORKERS", "0"))  # processes for block verification, 0 to verify inline
+VERIFY_PARALLEL_MIN = int(os.getenv("VERIFY_PARALLEL_MIN", "16"))  # smaller blocks are verified inline
+VERIFIED_CACHE_SIZE = int(os.getenv("VERIFIED_CACHE_SIZE", "100000"))  # max remembered verified signatures
+
+# parsed public keys of the worker process, by PEM string
+worker_verifiers = {}
+
+
+def verify_chunk(items: list) -> list:
+    """
+    Runs inside a worker process. Every item is a (public key PEM, signed bytes, signature hex) tuple.
+    Returns a list with the result of each verification.
+    """
+    results = []
+    for public_key, message, signature in items:
+        verifier = worker_verifiers.get(public_key)
+        if verifier is None:
+            verifier = make_verifier(public_key)
+            worker_verifiers[public_key] = verifier
+        try:
+            results.append(verifier.verify(SHA256.new(message), bytes.fromhex(signature)))
+        except ValueError:
+            results.append(False)
+    return results
+
+
+def warm_up() -> int:
+    return os.getpid()
+
+
+class VerifiedCache:
+    """
+    Bounded (LRU) set of transactions whose signature has already been verified, keyed by transaction_id and
+    signature. The digest of the signed contents is stored too, so a transaction whose fields were changed
+    while keeping the same id and signature is not treated as a hit.
+    """
+
+    def __init__(self, max_size=VERIFIED_CACHE_SIZE) -> None:
+        self.max_size = max_size
+        self.entries = OrderedDict()  # {(transaction_id, signature): digest}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def contains(self, transaction) -> bool:
+        key = (transaction.transaction_id, transaction.signature)
+        with self.lock:
+            digest = self.entries.get(key)
+            if digest is not None and digest == transaction.hash_transaction().digest():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def add(self, transaction) -> None:
+        key = (transaction.transaction_id, transaction.signature)
+        digest = transaction.hash_transaction().digest()
+        with self.lock:
+            self.entries[key] = digest
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"size": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+
+class SignatureVerifier:
+    """
+    Verifies the signatures of many transactions at once (e.g. the contents of a block) on a pool of processes,
+    since RSA verification is CPU-bound and does not run in parallel on threads.
+    """
+
+    def __init__(self, workers=VERIFY_WORKERS, parallel_min=VERIFY_PARALLEL_MIN) -> None:
+        self.workers = workers
+        self.parallel_min = parallel_min
+        self.executor = None
+        if workers > 0:
+            self.executor = ProcessPoolExecutor(max_workers=workers)
+            # Start the worker processes now, before the node starts its other threads
+            list(self.executor.map(warm_up, range(workers)))
+
+    def verify_all(self, transactions: list, public_keys: dict, get_verifier, cache: VerifiedCache = None) -> bool:
+        """
+        Check that every transaction is signed by its sender. public_keys maps sender addresses to PEM keys and
+        get_verifier returns the cached verifier of an address, used when verifying inline.
+        Transactions found in the cache are not verified again, and the newly verified ones are added to it.
+        """
+        if cache is not None:
+            transactions = [transaction for transaction in transactions if not cache.contains(transaction)]
+
+        if self.executor is None or len(transactions) < self.parallel_min:
+            valid = all(transaction.verify_signature_with(get_verifier(transaction.sender_address))
+                        for transaction in transactions)
+        else:
+            items = [(public_keys[transaction.sender_address], transaction.stringify().encode('utf-8'),
+                      transaction.signature) for transaction in transactions]
+            chunk_size = -(-len(items) // self.workers)  # ceiling division, one chunk per worker
+            chunks = [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+            valid = all(all(results) for results in self.executor.map(verify_chunk, chunks))
+
+        if valid and cache is not None:
+            for transaction in transactions:
+                cache.add(transaction)
+        return valid
@@ -1,10 +1,23 @@
 import json
-import random
 import time
+from copy import deepcopy
 
 from src.block import Block
-from src.transaction import Transaction
-from src.blockchain import Blockchain
+from src.transaction import Transaction, make_verifier
+from src.blockchain import Blockchain, StoredChain
+from src.blockstore import BlockStore, BLOCK_STORE, BLOCK_STORE_DIR, SNAPSHOT_EVERY
+from src.state import StateJournal
+from src.mempool import Mempool, BLOCK_ASSEMBLY
+from src.nonces import NonceTracker
+from src.bounded import BoundedDict
+from src.capacity import CapacityController
+from src.lottery import Lottery
+from src.verifier import VerifiedCache
+from src.codec import (WIRE_FORMAT, BINARY_HEADERS, JSON_HEADERS, DECODE_ERRORS, encode_transactions,
+                       encode_block)
+from src.network import PeerPool, BlockDelivery, TransactionBatcher, GOSSIP_BATCH
+from src.sync import ChainSync
+from src.metrics import BROADCAST_TRANSACTION_SECONDS, MINE_BLOCK_SECONDS, new_lock, timed
 import requests
 
 from Crypto.PublicKey import RSA
@@ -22,6 +35,9 @@ BOOTSTRAP_PORT = int(os.getenv("BOOTSTRAP_PORT"))  # 5000
 INITIAL_COINS = int(os.getenv("INITIAL_COINS"))  # 1000
 PRINT_TRANS = int(os.getenv("PRINT_TRANS")) # for printing
 UNFAIR = int(os.getenv("UNFAIR"))
+# seal a block (with fewer than CAPACITY transactions) once the oldest pending transaction has waited
+# this many seconds, so the last transactions of a burst are not left pending; 0 to seal blocks only when they are full
+BLOCK_MAX_WAIT = float(os.getenv("BLOCK_MAX_WAIT", "1"))
 
 INITIAL_STAKE = 10.0
 
@@ -32,55 +48,93 @@ class Wallet:
         self.port = port
         self.address = f"{ip_address}:{port}"
         self.bootstrap = bootstrap
-        self.balance = 0.0
-        self.stake = INITIAL_STAKE if not (UNFAIR and self.bootstrap) else 100.0
         self.nonce = 0  # counter for the number of transactions
-        self.private_key, self.public_key = self.generate_wallet()
 
-        self.blockchain_state = {}  # soft state
         """
         State will contain a dictionary of all the nodes:
         {address: {public_key, id, balance, stake} dictionaries}}
+        The soft state (self.blockchain_state) also includes the pending transactions,
+        the hard state (self.blockchain_state_hard) only the transactions contained in blocks.
         """
-        self.blockchain_state_hard = {}  # hard state
-
-        self.transactions_pending = {}  # received transactions that have not been added to a block yet
-        self.transactions_rejected = {}  # rejected transactions
+        self.state = StateJournal()
+        self.validator_lottery = Lottery()
+
+        self.mempool = Mempool()  # received transactions that have not been added to a block yet
+        # chooses the capacity of the blocks this node seals (fixed or adapted to the load)
+        self.block_capacity = CapacityController()
+        # the rejected, missing and own transactions are only kept for a while (see BoundedDict)
+        self.transactions_rejected = BoundedDict()  # rejected transactions
         # missing transaction: transactions that were contained in a received block
-        # but we have not yet received them individually
-        self.transactions_missing = {}
+        # but we have not yet received them individually (kept for the debug endpoints, a late transaction
+        # is recognized by its committed nonce)
+        self.transactions_missing = BoundedDict()
+
+        self.pending_blocks = {}  # blocks that have been received out of order, by index
 
-        self.pending_blocks = {}  # list of blocks that have been received out of order
+        # the chain is also kept on disk if the block store is enabled
+        store = BlockStore(os.path.join(BLOCK_STORE_DIR, f"{ip_address}_{port}")) if BLOCK_STORE else None
+        self.blockchain = Blockchain(store)
 
-        self.blockchain = Blockchain()
+        # persistent connections to the other nodes, used for broadcasting
+        self.peers = PeerPool()
+        # background delivery of mined blocks, with per-peer status
+        self.block_delivery = BlockDelivery(self.peers)
+        # coalesces outgoing transactions into batches (None if batching is disabled)
+        self.transaction_batcher = TransactionBatcher(self.peers) if GOSSIP_BATCH else None
+        # pulls missing blocks from the peers (when joining the network or after a restart)
+        self.chain_sync = ChainSync(self.peers)
 
         # lock that protects shared resources of the wallet object from race conditions
-        # due to simultaneous access from multiple threads
-        self.total_lock = threading.Lock()
-        # event that is set when the received (and pending) transactions exceed the capacity of the blocks
+        # due to simultaneous access from multiple threads. It is taken by the writers (transaction intake, blocks,
+        # mining), which also take the short locks of the state, the mempool and the chain for each change.
+        # Readers (the monitoring endpoints) only take those short locks, see StateJournal.snapshot.
+        # Its wait and hold times are recorded (see src/metrics.py).
+        self.total_lock = new_lock("total_lock")
+        # event that wakes up the block producer: set when the pending transactions reach the capacity of the blocks,
+        # when a block is added (the validator of the next block changes) and, if blocks are sealed after
+        # BLOCK_MAX_WAIT, whenever a transaction becomes pending
         self.capacity_full = threading.Event()
-        # event that is set whenever a block is added to the chain,
-        # in order to check if out of order blocks can now be added
-        self.received_block = threading.Event()
 
-        self.nonce_sets = {}  # nonce sets for each node
+        self.nonces = NonceTracker()  # the nonces used by each node, for replay protection
+        # the nonces of the transactions contained in blocks only, which are kept in the snapshots
+        # (the pending transactions are lost on a restart, so their nonces must not be marked used)
+        self.committed_nonces = NonceTracker()
+
+        # parsed public keys (signature verifiers) of the nodes, by address. Public keys never change
+        # after registration, so the PEM strings are parsed only once.
+        self.verifiers = {}
+        # transactions whose signature has already been verified, so blocks do not verify them again
+        self.verified_cache = VerifiedCache()
 
         # for debugging purposes
-        self.transaction_history = []
+        self.transaction_history = BoundedDict()
         self.processed_transactions = {}
 
         # for debugging purposes
         self.received_transactions_count = 0
         self.accepted_transactions_count = 0
 
+        # set if the node was restarted and recovered its chain and state from the block store
+        self.recovered = False
+        meta = store.load_meta() if store is not None else None
+        if meta is not None:
+            self.recover(meta)
+            return
+        if store is not None and len(store) > 0:
+            # the stored blocks belong to a node that never joined the network, start over
+            store.clear()
+
+        self.private_key, self.public_key = self.generate_wallet()
+
         if bootstrap:
             self.id = 0
             self.given_id = 0
-            self.blockchain_state[self.address] = {"public_key": self.public_key,
-                                                   "id": self.id,
-                                                   "balance": 0.0,
-                                                   "stake": INITIAL_STAKE if not UNFAIR else 100.0} # Initial stake is 5 coins, and 100 for the fairness experiment
+            self.state.register(self.address, {"public_key": self.public_key,
+                                               "id": self.id,
+                                               "balance": 0.0,
+                                               "stake": INITIAL_STAKE if not UNFAIR else 100.0}) # Initial stake is 5 coins, and 100 for the fairness experiment
 
+            self.cache_public_key(self.address, self.public_key)
             self.create_genesis_block()
         else:
             # Communicate with the bootstrap node to register in the blockchain
@@ -100,6 +154,26 @@ class Wallet:
             self.id = response.json()['id']
             print(f"New node ID is {self.id}.")
 
+    @property
+    def blockchain_state(self) -> dict:
+        return self.state.soft
+
+    @property
+    def blockchain_state_hard(self) -> dict:
+        return self.state.hard
+
+    @property
+    def balance(self) -> float:
+        if self.address not in self.blockchain_state:
+            return 0.0
+        return round(self.blockchain_state[self.address]["balance"], 3)
+
+    @property
+    def stake(self) -> float:
+        if self.address not in self.blockchain_state:
+            return INITIAL_STAKE
+        return self.blockchain_state[self.address]["stake"]
+
     def create_genesis_block(self):
         # we call the create transaction function (the same as init of transaction)
         tran = self.create_transaction(sender_address='0',
@@ -108,12 +182,126 @@ class Wallet:
                                        amount=INITIAL_COINS * TOTAL_NODES,
                                        message="Genesis block",
                                        nonce=self.nonce)
-        # We don't verify the transaction because it's the genesis block, so we process it directly
-        self.process_transaction(tran)
+        # We don't verify the transaction because it's the genesis block, so we commit it directly
+        self.state.commit(tran)
         genesis_block = Block(index=0, timestamp=time.time(),
                               transactions=[tran], validator=-1, previous_hash='1')
         self.blockchain.add_block(genesis_block)
 
+    def save_node_info(self) -> None:
+        """
+        Keep what is needed to recover after a restart in the block store: the keys, the id and the state
+        of the network before any block (the registered nodes with their initial stakes and no coins).
+        """
+        if self.blockchain.store is None:
+            return
+        base_state = {node: dict(entry, balance=0.0) for node, entry in self.blockchain_state_hard.items()}
+        self.blockchain.store.save_meta({"id": self.id,
+                                         "given_id": getattr(self, "given_id", None),
+                                         "private_key": self.private_key,
+                                         "public_key": self.public_key,
+                                         "base_state": base_state})
+
+    def recover(self, meta: dict) -> None:
+        """
+        Rebuild the chain and the hard state from the block store. The state is loaded from the newest snapshot
+        that matches the stored chain (or the base state, if there is none) and only the blocks after it are
+        replayed. The blocks before the snapshot are read from the store only if they are needed.
+        """
+        start = time.time()
+        self.recovered = True
+        self.id = meta["id"]
+        if self.bootstrap:
+            self.given_id = meta["given_id"]
+        self.private_key, self.public_key = meta["private_key"], meta["public_key"]
+
+        store = self.blockchain.store
+        snapshot = None
+        for candidate in store.load_snapshots():
+            height = candidate["height"]
+            if 0 < height <= len(store):
+                block = self.load_block(height - 1)
+                if block is not None and block.current_hash == candidate["block_hash"]:
+                    snapshot = candidate
+                    break
+
+        if snapshot is not None:
+            height = snapshot["height"]
+            self.state.reset(snapshot["hard_state"])
+            self.nonces.load(snapshot["nonces"])
+            self.committed_nonces.load(snapshot["nonces"])
+            self.nonce = snapshot["nonce"]
+        else:
+            height = 0
+            self.state.reset(meta["base_state"])
+            self.nonces.reset(self.blockchain_state.keys())
+            self.committed_nonces.reset(self.blockchain_state.keys())
+        for node, entry in self.blockchain_state.items():
+            self.cache_public_key(node, entry["public_key"])
+        self.blockchain.chain = StoredChain(height, self.load_block)
+
+        for height in range(height, len(store)):
+            block = self.load_block(height)
+            if block is None:
+                print(f"Stored block {height} is corrupted, recovering up to block {height - 1}.")
+                # drop it and the blocks after it, so the next block is stored at this height
+                store.truncate(height)
+                break
+            self.blockchain.add_block(block, persist=False)
+            self.replay_block(block)
+
+        print(f"Recovered {len(self.blockchain.chain)} blocks from the block store in "
+              f"{time.time() - start:.3f} s ({len(self.blockchain.chain.blocks)} replayed after the snapshot).")
+
+    def load_block(self, height: int):
+        """Read a block from the block store. None if the stored block cannot be decoded or does not match its hash."""
+        try:
+            fields, transactions = self.blockchain.store.read(height)
+        except DECODE_ERRORS + (KeyError,) as e:
+            print(f"Error: could not decode stored block {height}: {e!r}")
+            return None
+        block = Block(fields["index"], fields["timestamp"], transactions, fields["validator"],
+                      fields["previous_hash"], fields["capacity"])
+        if block.current_hash != fields["current_hash"]:
+            return None
+        return block
+
+    def snapshot_if_due(self) -> None:
+        """
+        After adding a block, take a snapshot of the hard state and the nonce tracking if the height is a multiple
+        of SNAPSHOT_EVERY. The state is copied while the caller holds the lock and written in the background.
+        """
+        store = self.blockchain.store
+        height = len(self.blockchain.chain)
+        if store is None or not SNAPSHOT_EVERY or height % SNAPSHOT_EVERY != 0:
+            return
+        snapshot = {"height": height,
+                    "block_hash": self.blockchain.chain[-1].current_hash,
+                    "hard_state": deepcopy(self.blockchain_state_hard),
+                    "nonces": self.committed_nonces.to_dict(),
+                    "nonce": self.nonce}
+        threading.Thread(target=store.save_snapshot, args=(height, snapshot), daemon=True).start()
+
+    def replay_block(self, block: Block) -> None:
+        """Apply a block of the chain to the hard state (and the nonce tracking), without validating it."""
+        for transaction in block.transactions:
+            self.state.commit(transaction)
+            if transaction.sender_address == '0':
+                continue
+            self.nonces.add(transaction.sender_address, transaction.nonce)
+            self.committed_nonces.add(transaction.sender_address, transaction.nonce)
+            if transaction.sender_address == self.address:
+                self.nonce = max(self.nonce, transaction.nonce)
+
+        if block.validator != -1:
+            self.state.credit(self.address_of(block.validator), block.calculate_reward())
+
+    def address_of(self, id: int) -> str:
+        for node, entry in self.blockchain_state.items():
+            if entry['id'] == id:
+                return node
+        return None
+
     @staticmethod
     def generate_wallet() -> tuple:
         rsa_keypair = RSA.generate(2048)
@@ -122,67 +310,37 @@ class Wallet:
         return private_key.decode(), public_key.decode()
 
     def process_transaction(self, transaction: Transaction, use_soft=True) -> None:
-        # Case: Stake, check also self.stake
-        if transaction.receiver_address == "0":
-            if use_soft:
-                self.blockchain_state[transaction.sender_address]["stake"] = transaction.amount
-            else:
-                self.blockchain_state_hard[transaction.sender_address]["stake"] = transaction.amount
-            if transaction.sender_address == self.address:
-                self.stake = transaction.amount
-
-        # Case: Coins
-        elif transaction.type_of_transaction == "coins":
-            # Check if self is receiving/sending
-            if transaction.receiver_address == self.address:
-                self.balance += transaction.amount
-            elif transaction.sender_address == self.address:
-                self.balance -= transaction.amount
-
-            # Update the blockchain state balance for the sender
-            if transaction.sender_address != "0":
-                if use_soft:
-                    self.blockchain_state[transaction.sender_address]["balance"] -= transaction.amount
-                else:
-                    self.blockchain_state_hard[transaction.sender_address]["balance"] -= transaction.amount
-                # 3% fee for the sender (the initial 1000 BCC transactions don't have a fee)
-                fee = round(transaction.amount * 0.03, 3) if transaction.message != "Initial Transaction" else 0
-                if use_soft:
-                    self.blockchain_state[transaction.sender_address]["balance"] -= fee
-                else:
-                    self.blockchain_state_hard[transaction.sender_address]["balance"] -= fee
-                if transaction.sender_address == self.address:
-                    self.balance -= fee
-
-            # Update blockchain state for receiver
-            if use_soft:
-                self.blockchain_state[transaction.receiver_address]["balance"] += transaction.amount
-            else:
-                self.blockchain_state_hard[transaction.receiver_address]["balance"] += transaction.amount
-
-        elif transaction.type_of_transaction == "message":
-            fee = len(transaction.message)
-            if use_soft:
-                self.blockchain_state[transaction.sender_address]["balance"] -= fee
-            else:
-                self.blockchain_state_hard[transaction.sender_address]["balance"] -= fee
-            if transaction.sender_address == self.address:
-                self.balance -= transaction.amount
-
-        self.balance = round(self.balance, 3)
-
-        if not use_soft:
+        """
+        With use_soft, the transaction is pending and only the soft state is updated.
+        Otherwise, the transaction is contained in a block and it is committed to the hard state.
+        """
+        if use_soft:
+            self.state.add_pending(transaction)
+        else:
+            self.state.commit(transaction)
             self.accepted_transactions_count += 1
 
         return
 
     def register_node(self, address: str, public_key: str) -> None:
-        self.blockchain_state[address] = {"public_key": public_key,
-                                          "id": self.given_id,
-                                          "balance": 0.0,
-                                          "stake": INITIAL_STAKE}
+        self.state.register(address, {"public_key": public_key,
+                                      "id": self.given_id,
+                                      "balance": 0.0,
+                                      "stake": INITIAL_STAKE})
+        self.cache_public_key(address, public_key)
         return
 
+    def cache_public_key(self, address: str, public_key: str) -> None:
+        self.verifiers[address] = make_verifier(public_key)
+
+    def get_verifier(self, address: str):
+        verifier = self.verifiers.get(address)
+        if verifier is None:
+            # not cached yet (e.g. the state was replaced), parse it now
+            verifier = make_verifier(self.blockchain_state[address]["public_key"])
+            self.verifiers[address] = verifier
+        return verifier
+
     @staticmethod
     def create_transaction(sender_address: str, receiver_address: str,
                            type_of_transaction: str, amount: float, message: str, nonce: int
@@ -190,53 +348,111 @@ class Wallet:
         transaction = Transaction(sender_address, receiver_address, type_of_transaction, amount, message, nonce)
         return transaction
 
+    @timed(BROADCAST_TRANSACTION_SECONDS)
     def broadcast_transaction(self, transaction: Transaction) -> bool:
+        if not self.prepare_transaction(transaction):
+            return False
+
+        nodes = self.peer_addresses()
+        if self.transaction_batcher is not None:
+            if not self.transaction_batcher.submit(nodes, transaction).result():
+                return False
+        else:
+            payload, headers = self.transaction_payload(transaction)
+            results = self.peers.broadcast(nodes, "/api/receive_transaction", payload, headers)
+            if not self.peers.succeeded(nodes, results):
+                return False
+
+        return self.add_own_transaction(transaction)
+
+    def prepare_transaction(self, transaction: Transaction) -> bool:
+        """Give the next nonce to an own transaction and sign it, before it is broadcast."""
+        if self.mempool.full():
+            print("Error: the mempool is full, try again later.")
+            return False
+
         # Increment the nonce of the wallet to keep track of the number of transactions
         # and prevent replay attacks/double spending
         self.nonce += 1
         transaction.nonce = self.nonce
 
-        self.transaction_history.append(transaction)
+        self.transaction_history[transaction.transaction_id] = transaction
 
         transaction.sign_transaction(self.private_key)
+        return True
 
+    @staticmethod
+    def transaction_payload(transaction: Transaction) -> tuple:
+        """The payload and headers of a single transaction for /api/receive_transaction."""
+        if WIRE_FORMAT == "binary":
+            return encode_transactions([transaction]), BINARY_HEADERS
         data = {
             "transaction": transaction.serialize()
         }
-        payload = json.dumps(data)
-        for node in self.blockchain_state.keys():
-            if node == self.address:
-                continue
-            node_ip = node.split(":")[0]
-            node_port = node.split(":")[1]
-            response = requests.post(f"http://{node_ip}:{node_port}/api/receive_transaction",
-                                     data=payload,
-                                     headers={'Content-Type': 'application/json'})
-            if response.status_code != 200:
-                print("Error:", response.json())
-                return False
+        return json.dumps(data), JSON_HEADERS
 
+    def add_own_transaction(self, transaction: Transaction) -> bool:
+        """
+        Add an own transaction to the pending ones, once the peers have received it. Returns False if the mempool
+        filled up since prepare_transaction: the transaction then only takes effect if a block of a peer contains it.
+        """
         self.total_lock.acquire()
         
-        self.nonce_sets[transaction.sender_address].add(self.nonce)
+        self.nonces.add(transaction.sender_address, transaction.nonce)
 
-        # If, before we add our own transaction to pending list, we receive it from a block, it will be in missing list
-        # Then, do not process it, just return.
-        if transaction.transaction_id in self.transactions_missing:
-            del self.transactions_missing[transaction.transaction_id]
+        # If, before we add our own transaction to pending list, we receive it from a block, its nonce is committed
+        # (and it is in the missing list, unless it was evicted). Then, do not process it, just return.
+        if self.committed_nonces.used(transaction.sender_address, transaction.nonce):
+            self.transactions_missing.pop(transaction.transaction_id)
             self.total_lock.release()
             return True
 
-        if transaction.sender_address != '0':
-            self.transactions_pending[transaction.transaction_id] = transaction
+        if transaction.sender_address != '0' and not self.mempool.add(transaction):
+            self.total_lock.release()
+            print("Error: the mempool is full, the transaction was not added.")
+            return False
         self.process_transaction(transaction)
-        if len(self.transactions_pending) >= CAPACITY:
-            self.capacity_full.set()
+        self.notify_producer()
 
         self.total_lock.release()
-
         return True
 
+    def notify_producer(self) -> None:
+        """Called after a transaction is added to the mempool, wakes up the block producer if it may have to act."""
+        self.block_capacity.record_arrival()
+        if len(self.mempool) >= self.block_capacity.capacity() or BLOCK_MAX_WAIT:
+            self.capacity_full.set()
+
+    def block_due(self, capacity: int) -> bool:
+        """A block is sealed when the pending transactions fill its capacity, or when the oldest one has
+        waited BLOCK_MAX_WAIT seconds (if set)."""
+        pending = len(self.mempool)
+        if pending >= capacity:
+            return True
+        return bool(BLOCK_MAX_WAIT) and pending > 0 and self.mempool.oldest_age() >= BLOCK_MAX_WAIT
+
+    def next_block_wait(self):
+        """
+        How long the block producer can sleep before the next block is due: 0 to seal a block now, or None to
+        sleep until it is woken up (no pending transactions, no genesis block pulled yet, or another node is the
+        validator of the next block).
+        """
+        self.total_lock.acquire()
+        try:
+            if len(self.mempool) == 0 or len(self.blockchain.chain) == 0 or self.lottery() != self.id:
+                return None
+            if self.block_due(self.block_capacity.capacity()):
+                return 0
+            if not BLOCK_MAX_WAIT:
+                return None
+            return max(BLOCK_MAX_WAIT - self.mempool.oldest_age(), 0.001)
+        finally:
+            self.total_lock.release()
+
+    def peer_addresses(self) -> list:
+        # list() copies the keys at once, so a node registering at the same time does not break the iteration
+        return [node for node in list(self.blockchain_state) if node != self.address]
+
     def stake_amount(self, amount: int) -> bool:
         """Stake a certain amount of coins to be able to mine a block
            A transaction is created to stake the amount of coins
@@ -257,34 +473,47 @@ class Wallet:
         print("Error: Transaction was not broadcasted.")
         return False
 
+    @timed(MINE_BLOCK_SECONDS)
     def mine_block(self) -> bool:
+        """
+        Mining is split in two phases. The block is sealed and committed locally while holding the lock,
+        and then it is delivered to the peers in the background, so the lock is not held during the broadcast.
+        """
         self.total_lock.acquire()
-        CURRENT_BLOCK_TRANSACTIONS = list(self.transactions_pending.values())[:CAPACITY]
+        start = time.time()
+
+        # a joining node may receive transactions before it has pulled the genesis block
+        if len(self.blockchain.chain) == 0:
+            self.total_lock.release()
+            return True
 
         last_block = self.blockchain.chain[-1]
         validator = self.lottery()
-        # recheck if there are enough transactions because the miner thread might wake up due to timeout
-        if validator != self.id or len(list(self.transactions_pending)) <= CAPACITY:
+        capacity = self.block_capacity.capacity()
+        # recheck if a block is due because the pending transactions might have changed since the producer checked
+        if validator != self.id or not self.block_due(capacity):
             self.total_lock.release()
             return True
 
+        if BLOCK_ASSEMBLY == "fee":
+            CURRENT_BLOCK_TRANSACTIONS = self.mempool.take_by_fee(capacity, self.block_fits(self.state.overlay()))
+            if not CURRENT_BLOCK_TRANSACTIONS:
+                self.total_lock.release()
+                return True
+        else:
+            CURRENT_BLOCK_TRANSACTIONS = self.mempool.take(capacity)
+
         new_block = Block(index=last_block.index + 1, timestamp=time.time(),
                           transactions=CURRENT_BLOCK_TRANSACTIONS, validator=validator,
-                          previous_hash=last_block.current_hash)
+                          previous_hash=last_block.current_hash, capacity=capacity)
 
-        broadcast_result = self.broadcast_block(new_block)
-        if broadcast_result:
-            reward = new_block.calculate_reward()
-            self.balance += reward
-            self.blockchain_state[self.address]["balance"] += reward
-        else:
-            self.total_lock.release()
-            return False
+        reward = new_block.calculate_reward()
         self.blockchain.add_block(new_block)
 
-        # update hard state only with the transactions that were contained inside the broadcast block
+        # update hard state only with the transactions that were contained inside the block
         for transaction in CURRENT_BLOCK_TRANSACTIONS:
             self.process_transaction(transaction, False)
+            self.committed_nonces.add(transaction.sender_address, transaction.nonce)
             if PRINT_TRANS == 1:
                 file_path = f"{self.id}-trans.txt"
                 with open(file_path, 'a') as file:
@@ -300,47 +529,43 @@ class Wallet:
             file_path = f"{self.id}-trans-place.txt"
             with open(file_path, 'a') as file:
                 file.write(f"{self.address} is given {reward} FROM MINE_BLOCK\n")
-        self.blockchain_state_hard[self.address]["balance"] += reward
+        self.state.credit(self.address, reward)
+
+        self.snapshot_if_due()
 
-        self.transactions_pending = dict(list(self.transactions_pending.items())[CAPACITY:])
+        nodes = self.peer_addresses()
+        self.block_capacity.record_apply(time.time() - start)
 
         self.total_lock.release()
 
+        self.broadcast_block(new_block, nodes)
+
         return True
 
-    def broadcast_block(self, block: Block) -> bool:
-        payload = block.serialize()
-        response = None
-        for node in self.blockchain_state.keys():
-            if node == self.address:
-                continue
-            node_ip = node.split(":")[0]
-            node_port = node.split(":")[1]
-            response = requests.post(f"http://{node_ip}:{node_port}/api/receive_block",
-                                     data=payload,
-                                     headers={'Content-Type': 'application/json'})
-            if response.status_code != 200:
-                print("Error:", response.json())
-                break
-        if response.status_code == 200:
+    @staticmethod
+    def block_fits(overlay):
+        """
+        For fee-priority blocks: check the balance of each selected transaction against the hard state plus
+        the transactions selected before it, in the order of the block, as the other nodes will do.
+        """
+        def fits(transaction: Transaction) -> bool:
+            entry = overlay[transaction.sender_address]
+            if not transaction.verify_balance(entry["balance"], entry["stake"]):
+                return False
+            overlay.apply(transaction)
             return True
+        return fits
+
+    def broadcast_block(self, block: Block, nodes: list) -> None:
+        """Queue the block for delivery to every peer. The status of each peer is kept in self.block_delivery."""
+        if WIRE_FORMAT == "binary":
+            self.block_delivery.submit(nodes, block.index, encode_block(block), BINARY_HEADERS)
         else:
-            return False
+            self.block_delivery.submit(nodes, block.index, block.serialize(), JSON_HEADERS)
 
     def lottery(self, idx=0):
-        """Select a random node to mine a block"""
-        # Create a lottery where the probability of winning is proportional to the stake of each node
-        lottery = []
-        id_list = [entry['id'] for entry in self.blockchain_state.values()]
-        nodes = self.blockchain_state.keys()
-        for id, node in zip(id_list, nodes):
-            lottery += [id] * int(100 * (self.blockchain_state[node]["stake"]))
-
-        # If there are no stakes, select a random node
-        if not lottery:
-            lottery = id_list
-
-        # Set the seed to be the hash of the last block (or the previous block if an idx is given)
-        random.seed(self.blockchain.chain[idx - 1].current_hash)
-        winner = lottery[random.randint(0, len(lottery) - 1)]
-        return winner
+        """Select a random node to mine a block, with probability proportional to the stake of each node"""
+        # The seed is the hash of the last block (or the previous block if an idx is given)
+        height = idx if idx != 0 else len(self.blockchain.chain)
+        previous_hash = self.blockchain.chain[height - 1].current_hash
+        return self.validator_lottery.draw(self.blockchain_state, self.state.stakes_version, height, previous_hash)